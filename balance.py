@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# balance runner: plays many seeded headless games of Party Rogue in parallel
+# and reports how deep they got, how long they lasted and what killed them.
+#
+# python balance.py --runs 1000 --turns 2000 --set HEAL_AMOUNT=30 --json report.json
+#
+
+import argparse
+import ast
+import json
+import multiprocessing
+
+import partyrogue as game
+
+
+#stats reported for every run, in report order
+RUN_STATS = ['depth', 'turns', 'level', 'xp']
+
+
+def init_worker(overrides):
+    #runs once in every worker process: no window, and the tuning values being tested
+    game.init_headless()
+    for (name, value) in overrides.items():
+        setattr(game, name, value)
+
+
+def run_playout(args):
+    #play one whole game with the given seed and return its stats
+    (seed, max_turns) = args
+    game.new_game(seed)
+    turns = game.play_headless(game.RandomAgent(), max_turns)
+
+    #experience spent on level-ups counts too
+    level = game.player.level
+    xp = game.player.combatant[0].xp + sum(game.LEVEL_UP_BASE + l * game.LEVEL_UP_FACTOR for l in range(1, level))
+
+    if game.game_state == 'dead':
+        death = getattr(game.player, 'killed_by', None) or 'unknown'
+    else:
+        death = 'survived'
+    return {'seed': seed, 'depth': game.dungeon_level, 'turns': turns, 'level': level, 'xp': xp, 'death': death}
+
+
+def summarize(runs):
+    #merge the stats of all runs into one report
+    summary = {'runs': len(runs)}
+    for stat in RUN_STATS:
+        values = sorted(run[stat] for run in runs)
+        summary[stat] = {
+            'mean': float(sum(values)) / len(values),
+            'median': values[len(values) // 2],
+            'min': values[0],
+            'max': values[-1]}
+
+    summary['depth_reached'] = {}
+    summary['deaths'] = {}
+    for run in runs:
+        summary['depth_reached'][run['depth']] = summary['depth_reached'].get(run['depth'], 0) + 1
+        summary['deaths'][run['death']] = summary['deaths'].get(run['death'], 0) + 1
+    return summary
+
+
+def print_report(summary):
+    print('Runs: ' + str(summary['runs']))
+    print('%-8s %10s %8s %8s %8s' % ('', 'mean', 'median', 'min', 'max'))
+    for stat in RUN_STATS:
+        s = summary[stat]
+        print('%-8s %10.2f %8d %8d %8d' % (stat, s['mean'], s['median'], s['min'], s['max']))
+
+    print('Depth reached:')
+    for (depth, count) in sorted(summary['depth_reached'].items()):
+        print('  %3d: %6d (%.1f%%)' % (depth, count, 100.0 * count / summary['runs']))
+
+    print('Outcome:')
+    for (death, count) in sorted(summary['deaths'].items(), key=lambda item: -item[1]):
+        print('  %-20s %6d (%.1f%%)' % (death, count, 100.0 * count / summary['runs']))
+
+
+def parse_override(text):
+    #NAME=VALUE, where NAME is a constant in partyrogue.py and VALUE a Python literal
+    (name, value) = text.split('=', 1)
+    if not hasattr(game, name):
+        raise argparse.ArgumentTypeError('partyrogue has no setting named ' + name)
+    return (name, ast.literal_eval(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play many headless games in parallel and report the results.')
+    parser.add_argument('--runs', type=int, default=100, help='number of games to play')
+    parser.add_argument('--turns', type=int, default=1000, help='maximum turns per game')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the first game; the others follow it')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--set', type=parse_override, action='append', default=[], metavar='NAME=VALUE',
+        help='override a partyrogue constant, e.g. HEAL_AMOUNT=30 or "MAX_MONSTERS_TABLE=[[3, 1]]"')
+    parser.add_argument('--json', metavar='PATH', help='also write every run and the summary to a JSON file')
+    options = parser.parse_args()
+
+    jobs = [(options.seed + i, options.turns) for i in range(options.runs)]
+    pool = multiprocessing.Pool(options.processes, init_worker, (dict(options.set),))
+    try:
+        runs = list(pool.imap_unordered(run_playout, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    runs.sort(key=lambda run: run['seed'])
+
+    summary = summarize(runs)
+    print_report(summary)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'settings': dict(options.set), 'runs': runs, 'summary': summary}, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,7 @@
 import sys
 import ctypes
 import struct
+from array import array
 from ctypes import *
 
 if not hasattr(ctypes, "c_bool"):   # for Python < 2.6
@@ -395,13 +396,23 @@ class Key(Structure):
               ('shift', c_bool),
               ]
 
+def _int_array_pointer(arr):
+    # a pointer to the ints of an array('i'), for passing it to libtcod
+    # without a copy.
+    return cast(arr.buffer_info()[0], POINTER(c_int))
+
+def _is_int_array(arr):
+    return isinstance(arr, array) and arr.typecode == 'i'
+
 class ConsoleBuffer:
     # simple console that allows direct (fast) access to cells. simplifies
-    # use of the "fill" functions.
+    # use of the "fill" functions. each color channel, and the characters,
+    # are kept in a contiguous array('i') of C ints, row by row (index
+    # y * width + x), which blit hands to libtcod as they are. the arrays can
+    # be read and written directly, slices included.
     def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
         # initialize with given width and height. values to fill the buffer
         # are optional, defaults to black with no characters.
-        n = width * height
         self.width = width
         self.height = height
         self.clear(back_r, back_g, back_b, fore_r, fore_g, fore_b, char)
@@ -410,26 +421,26 @@ class ConsoleBuffer:
         # clears the console. values to fill it with are optional, defaults
         # to black with no characters.
         n = self.width * self.height
-        self.back_r = [back_r] * n
-        self.back_g = [back_g] * n
-        self.back_b = [back_b] * n
-        self.fore_r = [fore_r] * n
-        self.fore_g = [fore_g] * n
-        self.fore_b = [fore_b] * n
-        self.char = [ord(char)] * n
+        self.back_r = array('i', [back_r]) * n
+        self.back_g = array('i', [back_g]) * n
+        self.back_b = array('i', [back_b]) * n
+        self.fore_r = array('i', [fore_r]) * n
+        self.fore_g = array('i', [fore_g]) * n
+        self.fore_b = array('i', [fore_b]) * n
+        self.char = array('i', [ord(char)]) * n
 
     def copy(self):
         # returns a copy of this ConsoleBuffer.
         other = ConsoleBuffer(0, 0)
         other.width = self.width
         other.height = self.height
-        other.back_r = list(self.back_r)  # make explicit copies of all lists
-        other.back_g = list(self.back_g)
-        other.back_b = list(self.back_b)
-        other.fore_r = list(self.fore_r)
-        other.fore_g = list(self.fore_g)
-        other.fore_b = list(self.fore_b)
-        other.char = list(self.char)
+        other.back_r = array('i', self.back_r)  # make explicit copies of all arrays
+        other.back_g = array('i', self.back_g)
+        other.back_b = array('i', self.back_b)
+        other.fore_r = array('i', self.fore_r)
+        other.fore_g = array('i', self.fore_g)
+        other.fore_b = array('i', self.fore_b)
+        other.char = array('i', self.char)
         return other
 
     def set_fore(self, x, y, r, g, b, char):
@@ -458,20 +469,34 @@ class ConsoleBuffer:
         self.fore_b[i] = fore_b
         self.char[i] = ord(char)
 
+    def fill(self, x, y, w, h, back=None, fore=None, char=None):
+        # fill a rectangle, one slice per row and array. back and fore are
+        # (r, g, b) tuples and char a character; the ones left at None aren't
+        # changed.
+        planes = []
+        if back is not None:
+            planes += zip((self.back_r, self.back_g, self.back_b), back)
+        if fore is not None:
+            planes += zip((self.fore_r, self.fore_g, self.fore_b), fore)
+        if char is not None:
+            planes.append((self.char, ord(char)))
+        for (plane, value) in planes:
+            row = array('i', [value]) * w
+            for i in range(y * self.width + x, (y + h) * self.width + x, self.width):
+                plane[i:i + w] = row
+
     def blit(self, dest, fill_fore=True, fill_back=True):
         # use libtcod's "fill" functions to write the buffer to a console.
         if (console_get_width(dest) != self.width or
             console_get_height(dest) != self.height):
             raise ValueError('ConsoleBuffer.blit: Destination console has an incorrect size.')
 
-        s = struct.Struct('%di' % len(self.back_r))
-
         if fill_back:
-            _lib.TCOD_console_fill_background(dest, (c_int * len(self.back_r))(*self.back_r), (c_int * len(self.back_g))(*self.back_g), (c_int * len(self.back_b))(*self.back_b))
+            _lib.TCOD_console_fill_background(dest, _int_array_pointer(self.back_r), _int_array_pointer(self.back_g), _int_array_pointer(self.back_b))
 
         if fill_fore:
-            _lib.TCOD_console_fill_foreground(dest, (c_int * len(self.fore_r))(*self.fore_r), (c_int * len(self.fore_g))(*self.fore_g), (c_int * len(self.fore_b))(*self.fore_b))
-            _lib.TCOD_console_fill_char(dest, (c_int * len(self.char))(*self.char))
+            _lib.TCOD_console_fill_foreground(dest, _int_array_pointer(self.fore_r), _int_array_pointer(self.fore_g), _int_array_pointer(self.fore_b))
+            _lib.TCOD_console_fill_char(dest, _int_array_pointer(self.char))
 
 _lib.TCOD_console_credits_render.restype = c_bool
 _lib.TCOD_console_is_fullscreen.restype = c_bool
@@ -928,6 +953,11 @@ def console_fill_foreground(con,r,g,b) :
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
+    elif _is_int_array(r) and _is_int_array(g) and _is_int_array(b):
+        # array('i'), passed as they are
+        cr = _int_array_pointer(r)
+        cg = _int_array_pointer(g)
+        cb = _int_array_pointer(b)
     else:
         # otherwise convert using ctypes arrays
         cr = (c_int * len(r))(*r)
@@ -949,6 +979,11 @@ def console_fill_background(con,r,g,b) :
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
+    elif _is_int_array(r) and _is_int_array(g) and _is_int_array(b):
+        # array('i'), passed as they are
+        cr = _int_array_pointer(r)
+        cg = _int_array_pointer(g)
+        cb = _int_array_pointer(b)
     else:
         # otherwise convert using ctypes arrays
         cr = (c_int * len(r))(*r)
@@ -962,6 +997,9 @@ def console_fill_char(con,arr) :
         #numpy arrays, use numpy's ctypes functions
         arr = numpy.ascontiguousarray(arr, dtype=numpy.int32)
         carr = arr.ctypes.data_as(POINTER(c_int))
+    elif _is_int_array(arr):
+        #array('i'), passed as it is
+        carr = _int_array_pointer(arr)
     else:
         #otherwise convert using the struct module
         carr = struct.pack('%di' % len(arr), *arr)
@@ -1055,6 +1093,92 @@ def sys_check_for_event(mask,k,m) :
 def sys_wait_for_event(mask,k,m,flush) :
     return _lib.TCOD_sys_wait_for_event(c_int(mask),byref(k),byref(m),c_bool(flush))
 
+# headless mode
+_HEADLESS_PREFIXES = ('TCOD_console_', 'TCOD_sys_', 'TCOD_image_', 'TCOD_mouse_')
+
+class _NullFunction:
+    # stands in for a libtcod function that does nothing and returns 0.
+    restype = None
+    argtypes = None
+
+    def __call__(self, *args):
+        return 0
+
+class _HeadlessLib:
+    # forwards to the real library, except for the console, system, image
+    # and mouse functions, which do nothing. the random, fov, path and other
+    # modules keep working, so game logic runs without a window and without
+    # the frame rate limit.
+    def __init__(self, lib):
+        self.lib = lib
+        self.null_function = _NullFunction()
+
+    def __getattr__(self, name):
+        if name.startswith(_HEADLESS_PREFIXES):
+            return self.null_function
+        return getattr(self.lib, name)
+
+class _CountedFunction:
+    # calls a libtcod function, counting the call.
+    def __init__(self, name, function, counts):
+        self.name = name
+        self.function = function
+        self.counts = counts
+
+    def __call__(self, *args):
+        self.counts[self.name] = self.counts.get(self.name, 0) + 1
+        return self.function(*args)
+
+class _CountingLib:
+    # forwards to another library object, counting the calls to each function
+    # (see sys_set_call_counting).
+    def __init__(self, lib, counts):
+        self.lib = lib
+        self.counts = counts
+        self.functions = {}
+
+    def __getattr__(self, name):
+        function = self.functions.get(name)
+        if function is None:
+            function = _CountedFunction(name, getattr(self.lib, name), self.counts)
+            self.functions[name] = function
+        return function
+
+_real_lib = _lib
+_headless = False
+_call_counts = None
+
+def _update_lib():
+    global _lib
+    _lib = _real_lib
+    if _headless:
+        _lib = _HeadlessLib(_lib)
+    if _call_counts is not None:
+        _lib = _CountingLib(_lib, _call_counts)
+
+def sys_set_headless(headless=True):
+    # switch rendering and input on or off. call it before console_new and
+    # instead of console_init_root; consoles are then all 0 and input
+    # functions leave their Key and Mouse untouched.
+    global _headless
+    _headless = headless
+    _update_lib()
+
+def sys_is_headless():
+    return _headless
+
+def sys_set_call_counting(counting=True):
+    # count the calls made into libtcod from now on (or stop counting). this
+    # costs a little on every call, so it's off by default.
+    global _call_counts
+    _call_counts = {} if counting else None
+    _update_lib()
+
+def sys_get_call_counts():
+    # the number of calls to each libtcod function (by its C name) since
+    # counting started, or None if calls aren't being counted.
+    return _call_counts
+
 ############################
 # line module
 ############################
@@ -1556,6 +1680,137 @@ def map_get_width(map):
 def map_get_height(map):
     return _lib.TCOD_map_get_height(map)
 
+class _CMap(Structure):
+    # the start of libtcod's map_t, used to reach a map's cell array directly.
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', c_void_p),
+              ]
+
+_map_cell_layout = []
+
+def _map_get_cell_layout():
+    # work out how libtcod stores one cell: its size in bytes, and the offset
+    # and bit of the transparent and walkable flags. this is found by setting
+    # the flags on a scratch map and looking at which bytes change, so it
+    # doesn't depend on the compiler's struct packing. returns None if the
+    # cells don't look like anything we can fill directly.
+    if _map_cell_layout:
+        return _map_cell_layout[0]
+    layout = None
+    m = map_new(16, 1)
+    try:
+        cells = _CMap.from_address(c_void_p(m).value).cells
+        map_set_properties(m, 1, 0, True, False)
+        map_set_properties(m, 2, 0, True, False)
+        data = bytearray(string_at(cells, 16))
+        marked = [i for i in range(16) if data[i]]
+        if len(marked) == 2:
+            size = marked[1] - marked[0]
+            transparent = (marked[0] - size, data[marked[0]])
+            map_clear(m)
+            map_set_properties(m, 1, 0, False, True)
+            data = bytearray(string_at(cells, 16))
+            marked = [i for i in range(16) if data[i]]
+            if (len(marked) == 1 and 0 <= transparent[0] < size and
+                0 <= marked[0] - size < size):
+                walkable = (marked[0] - size, data[marked[0]])
+                layout = (size, transparent, walkable)
+    finally:
+        map_delete(m)
+    _map_cell_layout.append(layout)
+    return layout
+
+def _flat_flags(buf):
+    # turn a buffer of flags (bytearray, array.array, NumPy array of any
+    # shape, or any sequence) into a flat sequence of 0/1 ints.
+    if numpy_available and isinstance(buf, numpy.ndarray):
+        return (numpy.asarray(buf) != 0).astype(numpy.uint8).ravel()
+    return bytearray(1 if v else 0 for v in buf)
+
+def map_set_properties_bulk(m, transparent, walkable):
+    # set the properties of every cell of a map at once. transparent and
+    # walkable hold one flag per cell, row by row (index y * width + x). the
+    # cells are written with a single copy into the map when their layout is
+    # known; otherwise the map is cleared and only the transparent or walkable
+    # cells are set one by one.
+    cmap = _CMap.from_address(c_void_p(m).value)
+    n = cmap.nbcells
+    transparent = _flat_flags(transparent)
+    walkable = _flat_flags(walkable)
+    if len(transparent) != n or len(walkable) != n:
+        raise ValueError('map_set_properties_bulk: buffers must have one flag per map cell.')
+
+    layout = _map_get_cell_layout()
+    if layout is None:
+        map_clear(m)
+        w = cmap.width
+        for i in range(n):
+            if transparent[i] or walkable[i]:
+                map_set_properties(m, i % w, i // w, transparent[i], walkable[i])
+        return
+
+    (size, (toff, tbit), (woff, wbit)) = layout
+    if size == 1:
+        data = bytearray(((tbit if t else 0) | (wbit if w else 0)) for (t, w) in zip(transparent, walkable))
+    else:
+        data = bytearray(n * size)
+        for i in range(n):
+            if transparent[i]:
+                data[i * size + toff] |= tbit
+            if walkable[i]:
+                data[i * size + woff] |= wbit
+    memmove(cmap.cells, bytes(data), len(data))
+
+_map_fov_layout = []
+
+def _map_get_fov_layout():
+    # the offset and bit of the in-FOV flag in a cell, found like the other
+    # flags: by computing FOV on an open scratch map and looking at which byte
+    # of a cell changes. returns None if that can't be worked out.
+    if _map_fov_layout:
+        return _map_fov_layout[0]
+    layout = None
+    cell_layout = _map_get_cell_layout()
+    if cell_layout is not None:
+        size = cell_layout[0]
+        m = map_new(16, 1)
+        try:
+            cells = _CMap.from_address(c_void_p(m).value).cells
+            map_clear(m, True, True)
+            before = bytearray(string_at(cells, 16 * size))
+            map_compute_fov(m, 0, 0)
+            after = bytearray(string_at(cells, 16 * size))
+            changed = [i for i in range(size) if before[size + i] != after[size + i]]
+            if len(changed) == 1:
+                offset = changed[0]
+                bit = after[size + offset] & ~before[size + offset]
+                if bit and all(after[i * size + offset] & bit for i in range(16)):
+                    layout = (offset, bit)
+        finally:
+            map_delete(m)
+    _map_fov_layout.append(layout)
+    return layout
+
+def map_get_fov_bulk(m):
+    # the in-FOV flag of every cell of a map as a bytearray of 0/1, row by row
+    # (index y * width + x), read with a single copy out of the map when the
+    # cell layout is known, so it can be looked up without calling libtcod.
+    cmap = _CMap.from_address(c_void_p(m).value)
+    n = cmap.nbcells
+    layout = _map_get_fov_layout()
+    if layout is None:
+        w = cmap.width
+        return bytearray(1 if map_is_in_fov(m, i % w, i // w) else 0 for i in range(n))
+
+    (offset, bit) = layout
+    size = _map_get_cell_layout()[0]
+    flags = bytearray(string_at(cmap.cells, n * size)[offset::size])
+    if bit != 1:
+        flags = flags.translate(bytearray(1 if v & bit else 0 for v in range(256)))
+    return flags
+
 ############################
 # pathfinding module
 ############################
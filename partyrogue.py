@@ -4,9 +4,14 @@
 #
 
 import libtcodpy as libtcod
+import array
+import collections
+import heapq
 import math
+import sys
 import textwrap
-import shelve
+import profiler
+import savefile
 
 
 #actual size of the window
@@ -25,6 +30,7 @@ MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 INVENTORY_WIDTH = 50
+
 CHARACTER_SCREEN_WIDTH = 30
 LEVEL_SCREEN_WIDTH = 40
 
@@ -42,16 +48,56 @@ CONFUSE_NUM_TURNS = 10
 FIREBALL_RADIUS = 3
 FIREBALL_DAMAGE = 25
 
+#spawn tables for place_objects, as [value, from dungeon level] pairs (see from_dungeon_level)
+MAX_MONSTERS_TABLE = [[2, 1], [3, 4], [5, 6]]  # maximum number of monsters per room
+MAX_ITEMS_TABLE = [[1, 1], [2, 4]]  # maximum number of items per room
+MONSTER_CHANCE_TABLES = {
+    'orc fighter': [[80, 1]],  # orc always shows up, even if all other monsters have 0 chance
+    'troll': [[15, 3], [30, 5], [60, 7]]}
+ITEM_CHANCE_TABLES = {  # by default items have a chance of 0 at level 1, which then goes up
+    'heal': [[35, 1]],  # healing potion always shows up, even if all other items have 0 chance
+    'lightning': [[25, 4]],
+    'fireball': [[25, 6]],
+    'confuse': [[10, 2]],
+    'sword': [[5, 4]],
+    'shield': [[15, 8]]}
+
 #experience and level-ups
 LEVEL_UP_BASE = 200
 LEVEL_UP_FACTOR = 150
 
+#monsters out of sight are dormant and don't take turns, unless they're this close to the player
+#or hear a noise (a fight or a spell) within NOISE_RADIUS
+WAKE_RADIUS = 3
+NOISE_RADIUS = 8
+
+#how long an action takes, in ticks: every point of initiative makes it INITIATIVE_TICKS shorter
+ACTION_TICKS = 100
+INITIATIVE_TICKS = 5
+MIN_ACTION_TICKS = 25
+
 
 FOV_ALGO = 0  # default FOV algorithm
 FOV_LIGHT_WALLS = True  # light walls or not
 TORCH_RADIUS = 10
 
-LIMIT_FPS = 20  # 20 frames-per-second maximum
+LIMIT_FPS = 20  # 20 frames-per-second maximum. frames are only drawn after input (see wait_for_input)
+
+PROFILE_FILE = 'profile.csv'  # where the 'p' key writes the frame timings when profiling is turned off
+
+#the game's separate random streams: the map layout, what's placed on it, monster behaviour,
+#headless agents' choices, and things that only change the looks (see seed_game)
+RNG_STREAMS = ['mapgen', 'loot', 'ai', 'agent', 'cosmetic']
+
+#every message is also kept in the history (see history_viewer), in a file in chunks of this many
+HISTORY_CHUNK = 256
+
+#the text of the kinds of event in the message log, filled in only when it's shown (see format_event)
+EVENT_FORMATS = {
+    'melee': '{actor} melee attacks {target} for {amount} hit points.',
+    'ranged': '{actor} ranged attacks {target} for {amount} hit points.',
+    'no effect': '{actor} attacks {target} but it has no effect!',
+    'burned': 'The {actor} gets burned for {amount} hit points.'}
 
 
 color_dark_wall = libtcod.Color(103, 103, 97)
@@ -70,33 +116,251 @@ yellow_potion_tile = 23 * 40 + 27
 white_potion_tile = 24 * 40 + 7
 corpse_tile = 22 * 40 + 36
 
+#how each kind of map tile is drawn: its character, and its color when explored and when in view.
+#the kind of a tile is its index in this list; for now that's just whether it blocks sight.
+TILE_KINDS = [
+    (floor_tile, color_dark_ground, color_light_ground),
+    (wall_tile, color_dark_wall, color_light_wall)]
+
 
+con = []
+panel = []
 objects = []
+object_index = []
+level_spawns = []
+level_baseline = []
 player = []
 inventory = []
 game_msgs = []
+message_history = None
+active_profiler = None  # a profiler.Profiler while frames are being profiled
 game_state = []
 dungeon_level = []
 fov_map = []
 fov_recompute = []
 level_map = []
+map_renderer = None  # MapRenderer of the level, made with the FOV map
+compositor = None  # Compositor of the level, made with the FOV map
+player_distances = None  # DistanceField to the player, made with the FOV map
+monster_scheduler = None  # MonsterScheduler of the level, made with the FOV map
 stairs = []
 mouse = []
 key = []
+visible_tiles = set()
+headless = False
+game_seed = 0
+rngs = {}  # random number generator of each stream, see seed_game
+rng_draws = {}  # numbers drawn from each stream since it was seeded, see set_stream_draws
+saved_records = {}  # the game's records as of the last save or autosave, see autosave
+journaled_history = 0  # how many events of the message history are in the save file or its journal
+autosave_countdown = 0
+
+
+def tile_property(plane):
+    #a Tile attribute that reads and writes one byte of the given TileMap plane
+    def get(self):
+        return getattr(self.tiles, plane)[self.index] != 0
 
+    def set(self, value):
+        getattr(self.tiles, plane)[self.index] = 1 if value else 0
 
-class Tile:
-    #a tile of the map and its properties
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
+    return property(get, set)
 
-        #all tiles start unexplored
-        self.explored = False
 
-        #by default, if a tile is blocked, it also blocks sight
-        if block_sight is None:
-            block_sight = blocked
-        self.block_sight = block_sight
+class Tile(object):
+    #a tile of the map and its properties. it doesn't store anything itself, it's a view into the TileMap planes.
+    __slots__ = ('tiles', 'index')
+
+    blocked = tile_property('blocked')
+    block_sight = tile_property('block_sight')
+    explored = tile_property('explored')
+
+    def __init__(self, tiles, index):
+        self.tiles = tiles
+        self.index = index
+
+
+class TileColumn(object):
+    #one column of a TileMap, so that level_map[x][y] keeps working
+    __slots__ = ('tiles', 'x')
+
+    def __init__(self, tiles, x):
+        self.tiles = tiles
+        self.x = x
+
+    def __getitem__(self, y):
+        return Tile(self.tiles, y * self.tiles.width + self.x)
+
+    def __len__(self):
+        return self.tiles.height
+
+
+class TileMap:
+    #the tiles of a level, stored as one byte per tile in a separate plane for each property,
+    #row by row (index y * width + x). all tiles start unexplored, and blocked tiles also block sight.
+
+    #translation table that turns 0 into 1 and 1 into 0, to invert a whole plane at once
+    INVERT = bytearray([1, 0]) + bytearray(254)
+    def __init__(self, width, height, blocked=True):
+        self.width = width
+        self.height = height
+        fill = 1 if blocked else 0
+        self.blocked = bytearray([fill]) * (width * height)
+        self.block_sight = bytearray([fill]) * (width * height)
+        self.explored = bytearray(width * height)
+
+    def __getitem__(self, x):
+        return TileColumn(self, x)
+
+    def __len__(self):
+        return self.width
+
+    def carve(self, x1, y1, x2, y2):
+        #make all tiles in the rectangle between (x1, y1) and (x2, y2) (inclusive) passable, a row at a time
+        length = x2 - x1 + 1
+        clear = bytearray(length)
+        for y in range(y1, y2 + 1):
+            start = y * self.width + x1
+            self.blocked[start:start + length] = clear
+            self.block_sight[start:start + length] = clear
+
+    def pack_explored(self):
+        #the explored plane packed into bits, 8 tiles per byte
+        packed = bytearray((len(self.explored) + 7) // 8)
+        for (i, explored) in enumerate(self.explored):
+            if explored:
+                packed[i >> 3] |= 1 << (i & 7)
+        return bytes(packed)
+
+    def unpack_explored(self, packed):
+        #set the explored plane from bits packed by pack_explored
+        packed = bytearray(packed)
+        for i in range(len(self.explored)):
+            self.explored[i] = (packed[i >> 3] >> (i & 7)) & 1
+
+    def transparent(self):
+        #one flag per tile telling if it can be seen through, as needed to seed the FOV map
+        return self.block_sight.translate(self.INVERT)
+
+    def walkable(self):
+        #one flag per tile telling if it can be walked on
+        return self.blocked.translate(self.INVERT)
+
+
+class MapRenderer:
+    #draws the map from a code for each tile: its kind times 4, plus 1 if it's explored and 2 if it's
+    #in view. the codes are turned into characters and colors for the whole map at once through lookup
+    #tables, and copied into a console with libtcod's fill functions. more kinds of tile only make the
+    #tables longer.
+    def __init__(self, tiles):
+        self.codes = bytearray(kind * 4 + explored for (kind, explored) in zip(tiles.block_sight, tiles.explored))
+        self.buffer = libtcod.ConsoleBuffer(tiles.width, tiles.height)
+
+        self.chars = []
+        self.colors = []
+        for (char, dark, lit) in TILE_KINDS:
+            self.chars += [ord(' '), char, char, char]
+            self.colors += [libtcod.black, dark, lit, lit]
+        self.reds = [color.r for color in self.colors]
+        self.greens = [color.g for color in self.colors]
+        self.blues = [color.b for color in self.colors]
+
+    def show(self, tiles):
+        #tiles came into view, and so are explored too
+        for (x, y) in tiles:
+            self.codes[y * self.buffer.width + x] |= 3
+
+    def hide(self, tiles):
+        for (x, y) in tiles:
+            self.codes[y * self.buffer.width + x] &= ~2
+
+    def render_tile(self, dest, x, y):
+        code = self.codes[y * self.buffer.width + x]
+        libtcod.console_set_char_foreground(dest, x, y, self.colors[code])
+        libtcod.console_set_char(dest, x, y, self.chars[code])
+
+    def render(self, dest):
+        buffer = self.buffer
+        buffer.char = array.array('i', map(self.chars.__getitem__, self.codes))
+        buffer.fore_r = array.array('i', map(self.reds.__getitem__, self.codes))
+        buffer.fore_g = array.array('i', map(self.greens.__getitem__, self.codes))
+        buffer.fore_b = array.array('i', map(self.blues.__getitem__, self.codes))
+        buffer.blit(dest, fill_back=False)
+
+
+class Compositor:
+    #puts the screen together from three layers: the map's tiles (MapRenderer), the objects on them and
+    #the panel. each layer keeps track of what changed (tiles coming into or out of view, tiles whose
+    #objects changed in object_index, the values shown by the panel's widgets) and only that is drawn again.
+    #anything else that draws on the screen, like a menu, has to call invalidate() afterwards.
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        #draw everything again next frame
+        self.everything = True
+        self.tiles = set()
+        self.panel_values = None  # what each widget of the panel last showed
+        self.player_looks = None
+
+    def mark(self, tiles):
+        self.tiles.update(tiles)
+
+    def render_map(self):
+        #returns whether the map changed
+        tiles = self.tiles | object_index.take_changes()
+        self.tiles = set()
+        looks = (player.x, player.y, player.char)  # the player changes looks without moving when it dies
+        if looks != self.player_looks:
+            self.player_looks = looks
+            tiles.add((player.x, player.y))
+
+        if self.everything:
+            self.everything = False
+            map_renderer.render(con)
+            #draw all objects in the list, except the player. we want it to
+            #always appear over all other objects! so it's drawn later.
+            for object in objects:
+                if object != player:
+                    object.draw()
+            player.draw()
+            return True
+
+        for (x, y) in tiles:
+            map_renderer.render_tile(con, x, y)
+            #only the object on top shows, and the player is always on top
+            top = None
+            for object in object_index.at(x, y):
+                if object.is_shown():
+                    top = object
+                    if object is player:
+                        break
+            if top is not None:
+                top.draw()
+        return len(tiles) > 0
+
+    def render_panel(self):
+        #returns the parts of the panel that changed, as (x, y, width, height)
+        everything = self.panel_values is None
+        if everything:
+            self.panel_values = {}
+            libtcod.console_set_default_background(panel, libtcod.black)
+            libtcod.console_clear(panel)
+
+        changed = []
+        for (area, value, draw) in hud_widgets():
+            if area in self.panel_values and self.panel_values[area] == value:
+                continue
+            self.panel_values[area] = value
+            (x, y, width, height) = area
+            libtcod.console_set_default_background(panel, libtcod.black)
+            libtcod.console_rect(panel, x, y, width, height, True, libtcod.BKGND_SET)
+            draw(x, y, width, value)
+            changed.append(area)
+
+        if everything:
+            return [(0, 0, SCREEN_WIDTH, PANEL_HEIGHT)]
+        return changed
 
 
 class Rect:
@@ -118,6 +382,192 @@ class Rect:
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
 
+class SpatialIndex:
+    #the objects on the map, bucketed by the tile they're on, so finding what's at (x, y)
+    #doesn't mean scanning the whole objects list. within a tile, objects keep their drawing order.
+    def __init__(self, objects=()):
+        self.cells = {}
+        self.changed = set()  # tiles whose objects changed since take_changes, to redraw them
+        for obj in objects:
+            self.add(obj)
+
+    def add(self, obj):
+        self.cells.setdefault((obj.x, obj.y), []).append(obj)
+        self.changed.add((obj.x, obj.y))
+
+    def remove(self, obj):
+        bucket = self.cells.get((obj.x, obj.y))
+        if bucket is not None and obj in bucket:
+            bucket.remove(obj)
+            self.changed.add((obj.x, obj.y))
+            if not bucket:
+                del self.cells[(obj.x, obj.y)]
+
+    def move(self, obj, x, y):
+        #put the object at new coordinates, moving it to the matching bucket
+        self.remove(obj)
+        obj.x = x
+        obj.y = y
+        self.add(obj)
+
+    def send_to_back(self, obj):
+        #make the object the first one in its tile, to match the objects list
+        bucket = self.cells[(obj.x, obj.y)]
+        bucket.remove(obj)
+        bucket.insert(0, obj)
+        self.changed.add((obj.x, obj.y))
+
+    def take_changes(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def at(self, x, y):
+        #all objects in a tile
+        return self.cells.get((x, y), ())
+
+    def blocker_at(self, x, y):
+        #the object blocking a tile, or None
+        for obj in self.cells.get((x, y), ()):
+            if obj.blocks:
+                return obj
+        return None
+
+    def items_at(self, x, y):
+        #the objects in a tile that can be picked up
+        return [obj for obj in self.cells.get((x, y), ()) if obj.item]
+
+    def in_radius(self, x, y, radius):
+        #all objects whose distance to (x, y) is at most radius. only the tiles in the enclosing
+        #square are looked at, unless there are fewer occupied tiles than that.
+        r = int(radius)
+        found = []
+        if (2 * r + 1) ** 2 <= len(self.cells):
+            for cy in range(y - r, y + r + 1):
+                for cx in range(x - r, x + r + 1):
+                    bucket = self.cells.get((cx, cy))
+                    if bucket and math.sqrt((cx - x) ** 2 + (cy - y) ** 2) <= radius:
+                        found.extend(bucket)
+        else:
+            for ((cx, cy), bucket) in self.cells.items():
+                if math.sqrt((cx - x) ** 2 + (cy - y) ** 2) <= radius:
+                    found.extend(bucket)
+        return found
+
+
+class DistanceField:
+    #walking distances from every tile to one spot (the player), computed by libtcod once each time
+    #the spot moves and shared by all monsters, so each one just steps downhill instead of pathfinding
+    def __init__(self, fov_map):
+        self.dijkstra = libtcod.dijkstra_new(fov_map)
+        self.origin = None
+        self.distances = {}
+
+    def update(self, x, y):
+        if (x, y) != self.origin:
+            libtcod.dijkstra_compute(self.dijkstra, x, y)
+            self.origin = (x, y)
+            self.distances = {}
+
+    def distance(self, x, y):
+        #-1 if the spot can't be reached. remembered until the spot moves, since monsters
+        #crowding around the player keep asking about the same tiles.
+        d = self.distances.get((x, y))
+        if d is None:
+            d = self.distances[(x, y)] = libtcod.dijkstra_get_distance(self.dijkstra, x, y)
+        return d
+
+    def step(self, x, y):
+        #the direction of the unblocked neighbour closest to the spot, or None if none is closer than (x, y)
+        best = None
+        best_distance = self.distance(x, y)
+        if best_distance < 0:
+            return None
+        for ny in range(max(y - 1, 0), min(y + 2, MAP_HEIGHT)):
+            for nx in range(max(x - 1, 0), min(x + 2, MAP_WIDTH)):
+                d = self.distance(nx, ny)
+                if 0 <= d < best_distance and not is_blocked(nx, ny):
+                    best = (nx - x, ny - y)
+                    best_distance = d
+        return best
+
+    def delete(self):
+        libtcod.dijkstra_delete(self.dijkstra)
+
+
+def action_ticks(obj):
+    #how long it takes an object to act, going by the initiative of the stack in front (the first
+    #one still alive), so the dead don't set the pace
+    if not obj.combatant:
+        return ACTION_TICKS
+    return max(MIN_ACTION_TICKS, ACTION_TICKS - front_combatant(obj).initiative * INITIATIVE_TICKS)
+
+
+class MonsterScheduler:
+    #decides which monsters take turns. only awake ones do; the dormant ones are left alone until they
+    #come into view, the player gets close or they hear a noise, and then catch up on the turns they missed.
+    #awake monsters wait in a heap ordered by the time of their next action, so faster ones act more often.
+    def __init__(self, objects=()):
+        self.turn = 0
+        self.time = 0
+        self.queue = []  # (time of next action, order, monster)
+        self.order = 0  # breaks ties between monsters acting at the same time, by when they were queued
+        self.awake = {}  # monster -> order of its entry in the queue; other entries are stale
+        self.dormant = {}  # monster -> turn it fell asleep
+        for obj in objects:
+            if obj.ai:
+                self.dormant[obj] = 0
+
+    def schedule(self, obj, time):
+        self.order += 1
+        self.awake[obj] = self.order
+        heapq.heappush(self.queue, (time, self.order, obj))
+
+    def wake(self, obj):
+        since = self.dormant.pop(obj, None)
+        if since is not None:
+            #its first action takes as long as any other, or it would get an extra one on the turn it wakes up
+            self.schedule(obj, self.time + action_ticks(obj))
+            if obj.ai and self.turn > since:
+                obj.ai.catch_up(self.turn - since)
+
+    def wake_tiles(self, tiles):
+        #dormant monsters don't move, so they can only come into view when the tiles they're on do
+        for (x, y) in tiles:
+            for obj in object_index.at(x, y):
+                if obj in self.dormant:
+                    self.wake(obj)
+
+    def wake_near(self, x, y, radius):
+        for obj in object_index.in_radius(x, y, radius):
+            if obj in self.dormant:
+                self.wake(obj)
+
+    def take_turns(self):
+        #the player just acted, which takes time: let the monsters act whose time comes before it's over
+        self.turn += 1
+        self.time += action_ticks(player)
+        self.wake_near(player.x, player.y, WAKE_RADIUS)
+        while self.queue and self.queue[0][0] <= self.time:
+            (time, order, obj) = heapq.heappop(self.queue)
+            if self.awake.get(obj) != order:
+                continue  # it fell asleep since
+            if obj.ai:
+                obj.ai.take_turn()
+            if obj.ai:
+                self.schedule(obj, time + action_ticks(obj))
+            else:
+                del self.awake[obj]
+
+        #monsters that are out of sight and away from the player go (back) to sleep
+        for obj in list(self.awake):
+            if obj.ai is None:
+                del self.awake[obj]
+            elif not in_fov(obj.x, obj.y) and obj.distance_to(player) > WAKE_RADIUS:
+                del self.awake[obj]
+                self.dormant[obj] = self.turn
+
+
 class Object:
     #this is a generic object: the player, a monster, an item, the stairs...
     #it's always represented by a character on screen.
@@ -129,10 +579,11 @@ class Object:
         self.color = color
         self.blocks = blocks
         self.always_visible = always_visible
+        self.spawn_id = None  # position in level_spawns, if it was placed by the level generator
         self.combatant = []
         if first_combatant is not None:  # let the combatant component know who owns it
             first_combatant.owner = self
-        self.combatant.append(first_combatant)
+            self.combatant.append(first_combatant)
 
         self.ai = ai
         if self.ai:  # let the AI component know who owns it
@@ -142,6 +593,8 @@ class Object:
         if self.item:  # let the Item component know who owns it
             self.item.owner = self
 
+        self.equipment_bonuses = None  # cached by get_equipment_bonuses
+
         self.equipment = equipment
         if self.equipment:  # let the Equipment component know who owns it
             self.equipment.owner = self
@@ -152,13 +605,13 @@ class Object:
 
     def add_combatant(self, combatant):
         if combatant is not None:
+            combatant.owner = self
             self.combatant.append(combatant)
 
     def move(self, dx, dy):
         #move by the given amount, if the destination is not blocked
         if not is_blocked(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+            object_index.move(self, self.x + dx, self.y + dy)
 
     def move_towards(self, target_x, target_y):
         #vector from this object to the target, and distance
@@ -187,20 +640,19 @@ class Object:
         global objects
         objects.remove(self)
         objects.insert(0, self)
+        object_index.send_to_back(self)
 
-    def draw(self):
-        global fov_map
+    def is_shown(self):
         #only show if it's visible to the player; or it's set to "always visible" and on an explored tile
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or
-            (self.always_visible and level_map[self.x][self.y].explored)):
+        return (in_fov(self.x, self.y) or
+            (self.always_visible and level_map.explored[self.y * MAP_WIDTH + self.x]))
+
+    def draw(self):
+        if self.is_shown():
             #set the color and then draw the character that represents this object at its position
             libtcod.console_set_default_foreground(con, self.color)
             libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
 
-    def clear(self):
-        #erase the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
-
 
 class Combatant:
     #movement-related properties and methods (monster, player, NPC).
@@ -238,96 +690,103 @@ class Combatant:
         self.death_function = death_function
 
     @property
-    def melee_power(self):  # return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.melee_power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_melee_power + bonus
+    def melee_power(self):  # return actual power, including the bonuses from all equipped items
+        return self.base_melee_power + get_equipment_bonuses(self.owner)['melee_power']
 
     @property
-    def melee_defense(self):  # return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.melee_defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_melee_defense + bonus
+    def melee_defense(self):  # return actual defense, including the bonuses from all equipped items
+        return self.base_melee_defense + get_equipment_bonuses(self.owner)['melee_defense']
 
     @property
-    def ranged_power(self):  # return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.ranged_power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_ranged_power + bonus
+    def ranged_power(self):  # return actual power, including the bonuses from all equipped items
+        return self.base_ranged_power + get_equipment_bonuses(self.owner)['ranged_power']
 
     @property
-    def ranged_defense(self):  # return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.ranged_defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_ranged_defense + bonus
+    def ranged_defense(self):  # return actual defense, including the bonuses from all equipped items
+        return self.base_ranged_defense + get_equipment_bonuses(self.owner)['ranged_defense']
 
     @property
-    def magic_power(self):  # return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.magic_power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_magic_power + bonus
+    def magic_power(self):  # return actual power, including the bonuses from all equipped items
+        return self.base_magic_power + get_equipment_bonuses(self.owner)['magic_power']
 
     @property
-    def magic_defense(self):  # return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.magic_defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_magic_defense + bonus
+    def magic_defense(self):  # return actual defense, including the bonuses from all equipped items
+        return self.base_magic_defense + get_equipment_bonuses(self.owner)['magic_defense']
 
     @property
-    def max_hp(self):  # return actual max_hp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_hp + bonus
+    def max_hp(self):  # return actual max_hp, including the bonuses from all equipped items
+        return self.base_max_hp + get_equipment_bonuses(self.owner)['max_hp']
 
     @property
-    def max_mp(self):  # return actual max_mp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_mp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_mp + bonus
+    def max_mp(self):  # return actual max_mp, including the bonuses from all equipped items
+        return self.base_max_mp + get_equipment_bonuses(self.owner)['max_mp']
 
     @property
-    def initiative(self):  # return actual initiative, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.initiative_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_initiative + bonus
+    def initiative(self):  # return actual initiative, including the bonuses from all equipped items
+        return self.base_initiative + get_equipment_bonuses(self.owner)['initiative']
 
     @property
-    def luck(self):  # return actual luck, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.luck_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_luck + bonus
+    def luck(self):  # return actual luck, including the bonuses from all equipped items
+        return self.base_luck + get_equipment_bonuses(self.owner)['luck']
+
+    def attack(self, target):
+        #attack the target's front stack with melee or ranged, whichever does more damage
+        front = front_combatant(target)
+        if attack_damage(self, front, 'ranged') > attack_damage(self, front, 'melee'):
+            self.ranged_attack(target)
+        else:
+            self.melee_attack(target)
 
     def melee_attack(self, target):
-        #a simple formula for attack damage
-        damage = self.melee_power - target.combatant[0].melee_defense
-
-        if damage > 0:
-            #make the target take some damage
-            message(self.owner.name.capitalize() + ' melee attacks ' + target.name + ' for ' + str(damage) + ' hit points.')
-            target.combatant[0].take_damage(damage)
-        else:
-            message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!')
+        self.strike(target, 'melee')
 
     def ranged_attack(self, target):
-        #a simple formula for ranged attack damage
-        damage = self.ranged_power - target.combatant[0].ranged_defense
+        self.strike(target, 'ranged')
+
+    def strike(self, target, kind):
+        #every one in the stack hits the target's front stack. party members are named in the log.
+        front = front_combatant(target)
+        damage = attack_damage(self, front, kind)
+        target_name = front.name if target == player else target.name
 
         if damage > 0:
             #make the target take some damage
-            message(self.owner.name.capitalize() + ' ranged attacks ' + target.name + ' for ' + str(damage) + ' hit points.')
-            target.combatant[0].take_damage(damage)
+            log_event(self.name, kind, target_name, damage)
+            front.take_damage(damage, self.name)
         else:
-            message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!')
+            log_event(self.name, 'no effect', target_name)
 
-    def take_damage(self, damage):
-        #apply damage if possible
+    def take_damage(self, damage, source=None):
+        #apply damage if possible. source is what dealt it, remembered as the killer if it's deadly
         if damage > 0:
-            self.hp -= damage
+            (hp, quantity) = pool_damage(self.hp, self.quantity, self.max_hp, damage)
+            self.set_health(hp, quantity, source)
 
-            #check for death. if there's a death function, call it
-            if self.hp <= 0:
-                if self.quantity > 1:
-                    self.quantity -= 1
-                else:
-                    function = self.death_function
-                    if function is not None:
-                        function(self.owner)
+    def set_health(self, hp, quantity, source=None):
+        #change hp and the number left in the stack, giving experience for the dead to the player.
+        #once the owner's last stack is gone, the death function is called.
+        killed = self.quantity - quantity
+        self.hp = hp
+        self.quantity = quantity
+        if killed <= 0:
+            return
+
+        if self.owner != player:  # yield experience to the player, kept by the first member still alive
+            front_combatant(player).xp += self.xp * killed
+
+        if not living_combatants(self.owner):
+            self.owner.killed_by = source
+            function = self.death_function
+            if function is not None:
+                function(self.owner)
 
-                if self.owner != player:  # yield experience to the player
-                    player.combatant[0].xp += self.xp
+    def is_alive(self):
+        return self.quantity > 0
 
     def heal(self, amount):
-        #heal by the given amount, without going over the maximum
+        #heal by the given amount, without going over the maximum. the dead stay dead.
+        if not self.is_alive():
+            return
         self.hp += amount
         if self.hp > self.max_hp:
             self.hp = self.max_hp
@@ -339,17 +798,23 @@ class AI_BasicMonster:
         #a basic monster takes its turn. if you can see it, it can see you
         monster = self.owner
 
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if in_fov(monster.x, monster.y):
 
-            #move towards player if far away
+            #move towards player if far away, around walls and other monsters
             if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+                step = player_distances.step(monster.x, monster.y)
+                if step is not None:
+                    monster.move(*step)
 
             #close enough, attack! (if the player is still alive.)
-            elif player.combatant[0].hp > 0:
-                begin_combat(monster)
+            elif living_combatants(player):
+                begin_combat(monster, player)
                 # monster.combatant[0].melee_attack(player)
 
+    def catch_up(self, turns):
+        #out of sight, a basic monster doesn't do anything, so there's nothing to catch up on
+        pass
+
 
 class AI_ConfusedMonster:
     #AI for a temporarily confused monster (reverts to previous AI after a while).
@@ -360,13 +825,17 @@ class AI_ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0:  # still confused...
             #move in a random direction, and decrease the number of turns confused
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(random_int('ai', -1, 1), random_int('ai', -1, 1))
             self.num_turns -= 1
 
         else:  # restore the previous AI (this one will be deleted because it's not referenced anymore)
             self.owner.ai = self.old_ai
             message('The ' + self.owner.name + ' is no longer confused!', libtcod.red)
 
+    def catch_up(self, turns):
+        #where it stumbled to while asleep doesn't matter, only that the confusion wears off
+        self.num_turns = max(0, self.num_turns - turns)
+
 
 class Item:
     #an item that can be picked up and used.
@@ -379,7 +848,9 @@ class Item:
             message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.red)
         else:
             inventory.append(self.owner)
-            objects.remove(self.owner)
+            remove_object(self.owner)
+            self.owner.spawn_id = None  # it's not part of the level anymore, even if dropped there again
+            invalidate_equipment_bonuses(player)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
 
             #special case: automatically equip, if the corresponding equipment slot is unused
@@ -393,10 +864,11 @@ class Item:
             self.owner.equipment.dequip()
 
         #add to the map and remove from the player's inventory. also, place it at the player's coordinates
-        objects.append(self.owner)
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
+        add_object(self.owner)
+        invalidate_equipment_bonuses(player)
         message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
     def use(self):
@@ -415,10 +887,29 @@ class Item:
 
 class Equipment:
     #an object that can be equipped, yielding bonuses. automatically adds the Item component.
-    def __init__(self, slot, melee_power_bonus=0, melee_defense_bonus=0, max_hp_bonus=0):
+    def __init__(
+    self,
+    slot,
+    melee_power_bonus=0,
+    melee_defense_bonus=0,
+    ranged_power_bonus=0,
+    ranged_defense_bonus=0,
+    magic_power_bonus=0,
+    magic_defense_bonus=0,
+    max_hp_bonus=0,
+    max_mp_bonus=0,
+    initiative_bonus=0,
+    luck_bonus=0):
         self.melee_power_bonus = melee_power_bonus
         self.melee_defense_bonus = melee_defense_bonus
+        self.ranged_power_bonus = ranged_power_bonus
+        self.ranged_defense_bonus = ranged_defense_bonus
+        self.magic_power_bonus = magic_power_bonus
+        self.magic_defense_bonus = magic_defense_bonus
         self.max_hp_bonus = max_hp_bonus
+        self.max_mp_bonus = max_mp_bonus
+        self.initiative_bonus = initiative_bonus
+        self.luck_bonus = luck_bonus
 
         self.slot = slot
         self.is_equipped = False
@@ -437,6 +928,7 @@ class Equipment:
 
         #equip object and show a message about it
         self.is_equipped = True
+        invalidate_equipment_bonuses(player)
         message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
 
     def dequip(self):
@@ -444,9 +936,58 @@ class Equipment:
         if not self.is_equipped:
             return
         self.is_equipped = False
+        invalidate_equipment_bonuses(player)
         message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
 
 
+def pool_damage(hp, quantity, max_hp, damage):
+    #hp and stack size after some damage. only the last one of a stack is ever hurt, and damage left over
+    #after killing it goes on to the next one, so the number killed can be worked out in one go.
+    hp -= damage
+    if hp > 0:
+        return (hp, quantity)
+    max_hp = max(max_hp, 1)
+    killed = min(quantity, -hp // max_hp + 1)
+    if killed >= quantity:
+        return (0, 0)
+    return (hp + killed * max_hp, quantity - killed)
+
+
+def spread_damage(hp, quantity, max_hp, damage):
+    #hp and stack size after every one in a stack takes damage on its own, and the hit points it
+    #took off. the one in front has hp left and the others max_hp; those that don't have more than
+    #damage die, and the one left in front is hurt by it.
+    dealt = 0
+    if hp <= damage:
+        #the one in front dies, and so do the others unless they can take the hit
+        dealt += hp
+        quantity -= 1
+        hp = max_hp
+        if max_hp <= damage:
+            return (0, 0, dealt + quantity * max_hp)
+    if quantity <= 0:
+        return (0, 0, dealt)
+    return (hp - damage, quantity, dealt + damage)
+
+
+def attack_damage(attacker, defender, kind):
+    #damage of one 'melee' or 'ranged' attack by every one in the attacker's stack
+    damage = getattr(attacker, kind + '_power') - getattr(defender, kind + '_defense')
+    return max(damage, 0) * attacker.quantity
+
+
+def living_combatants(obj):
+    return [combatant for combatant in obj.combatant if combatant.is_alive()]
+
+
+def front_combatant(obj):
+    #the stack that gets hit first: the first one still alive
+    for combatant in obj.combatant:
+        if combatant.is_alive():
+            return combatant
+    return obj.combatant[0]
+
+
 def get_equipped_in_slot(slot):  # returns the equipment in a slot, or None if it's empty
     for obj in inventory:
         if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
@@ -464,65 +1005,154 @@ def get_all_equipped(obj):  # returns a list of equipped items
         return []  # other objects have no equipment
 
 
+#the stats that equipment can give a bonus to (each Equipment has a <stat>_bonus attribute)
+EQUIPMENT_STATS = ['melee_power', 'melee_defense', 'ranged_power', 'ranged_defense', 'magic_power',
+    'magic_defense', 'max_hp', 'max_mp', 'initiative', 'luck']
+
+def get_equipment_bonuses(obj):
+    #returns a dict with the total bonus to each stat from the object's equipped items. it's
+    #only added up again after invalidate_equipment_bonuses, when the equipped items change.
+    bonuses = getattr(obj, 'equipment_bonuses', None)
+    if bonuses is None:
+        bonuses = dict((stat, 0) for stat in EQUIPMENT_STATS)
+        for equipment in get_all_equipped(obj):
+            for stat in EQUIPMENT_STATS:
+                bonuses[stat] += getattr(equipment, stat + '_bonus')
+        obj.equipment_bonuses = bonuses
+    return bonuses
+
+def invalidate_equipment_bonuses(obj):
+    #forget the cached bonuses, so they are added up again the next time a stat is read
+    obj.equipment_bonuses = None
+
+
+def add_object(obj):
+    #put an object on the map
+    objects.append(obj)
+    object_index.add(obj)
+
+
+def remove_object(obj):
+    #take an object off the map
+    objects.remove(obj)
+    object_index.remove(obj)
+
+
+def spawn_object(obj):
+    #put an object made by the level generator on the map. it's remembered by the order it was
+    #made in, so that saves only need to store how it changed since (see level_delta)
+    obj.spawn_id = len(level_spawns)
+    level_spawns.append(obj)
+    add_object(obj)
+
+
+def object_state(obj):
+    #the parts of an object that can change during play, to compare it with how it was generated
+    return (obj.x, obj.y, obj.char, obj.name, obj.blocks, obj.ai is not None,
+        tuple((combatant.hp, combatant.quantity) for combatant in obj.combatant))
+
+
+def set_object_state(obj, state):
+    #make a regenerated object match a state saved by object_state
+    (x, y, obj.char, obj.name, obj.blocks, has_ai, combatants) = state
+    object_index.move(obj, x, y)
+    if not has_ai:
+        obj.ai = None
+    obj.combatant = obj.combatant[:len(combatants)]
+    for (combatant, (hp, quantity)) in zip(obj.combatant, combatants):
+        combatant.hp = hp
+        combatant.quantity = quantity
+
+
+def level_delta():
+    #how the level differs from when it was generated: the new state of every generated object that
+    #changed (None if it's gone), and the objects that weren't generated at all, like dropped items
+    generated = {}
+    others = []
+    for obj in objects:
+        if obj is player:
+            continue
+        if getattr(obj, 'spawn_id', None) is None:
+            others.append(obj)
+        else:
+            generated[obj.spawn_id] = obj
+
+    changed = {}
+    for (spawn_id, baseline) in enumerate(level_baseline):
+        obj = generated.get(spawn_id)
+        if obj is None:
+            changed[spawn_id] = None
+        else:
+            state = object_state(obj)
+            if state != baseline:
+                changed[spawn_id] = state
+    return (changed, others)
+
+
+def apply_level_delta(changed, others):
+    #bring a freshly regenerated level back to how it was saved by level_delta
+    for (spawn_id, state) in changed.items():
+        obj = level_spawns[spawn_id]
+        if state is None:
+            remove_object(obj)
+        else:
+            set_object_state(obj, state)
+            if not obj.combatant:
+                obj.send_to_back()  # corpses appear below other objects
+    for obj in others:
+        add_object(obj)
+
+
 def is_blocked(x, y):
     #first test the map tile
-    if level_map[x][y].blocked:
+    if level_map.blocked[y * MAP_WIDTH + x]:
         return True
 
     #now check for any blocking objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
-
-    return False
+    return object_index.blocker_at(x, y) is not None
 
 
 def create_room(room):
-    global level_map
-    #go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            level_map[x][y].blocked = False
-            level_map[x][y].block_sight = False
+    #make the tiles inside the rectangle passable (its border stays as walls)
+    level_map.carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
 
 
 def create_h_tunnel(x1, x2, y):
-    global level_map
     #horizontal tunnel. min() and max() are used in case x1>x2
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        level_map[x][y].blocked = False
-        level_map[x][y].block_sight = False
+    level_map.carve(min(x1, x2), y, max(x1, x2), y)
 
 
 def create_v_tunnel(y1, y2, x):
-    global level_map
     #vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        level_map[x][y].blocked = False
-        level_map[x][y].block_sight = False
+    level_map.carve(x, min(y1, y2), x, max(y1, y2))
 
 
 def make_map():
-    global level_map, objects, stairs, player
+    global level_map, objects, object_index, stairs, player, level_spawns, level_baseline
+
+    #each level has its own map and loot streams, so it can be made again from the seed alone
+    seed_stream('mapgen', dungeon_level)
+    seed_stream('loot', dungeon_level)
 
-    #the list of objects with just the player
-    objects = [player]
+    #the list of objects. the player is only put in once the rooms are filled, so where they
+    #stood on the last level (or when the game was saved) can't change what's generated here
+    objects = []
+    object_index = SpatialIndex(objects)
+    level_spawns = []
 
     #fill level_map with "blocked" tiles
-    level_map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    level_map = TileMap(MAP_WIDTH, MAP_HEIGHT)
 
     rooms = []
     num_rooms = 0
 
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = random_int('mapgen', ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = random_int('mapgen', ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = random_int('mapgen', 0, MAP_WIDTH - w - 1)
+        y = random_int('mapgen', 0, MAP_HEIGHT - h - 1)
 
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -548,8 +1178,7 @@ def make_map():
 
             if num_rooms == 0:
                 #this is the first room, where the player starts at
-                player.x = new_x
-                player.y = new_y
+                start = (new_x, new_y)
             else:
                 #all rooms after the first:
                 #connect it to the previous room with a tunnel
@@ -558,7 +1187,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
 
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if random_int('mapgen', 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -571,13 +1200,20 @@ def make_map():
             rooms.append(new_room)
             num_rooms += 1
 
+    (player.x, player.y) = start
+    objects.insert(0, player)
+    object_index.add(player)
+
     #create stairs at the center of the last room
     stairs = Object(new_x, new_y, stairs_down_tile, 'stairs', libtcod.white, always_visible=True)
-    objects.append(stairs)
+    spawn_object(stairs)
+
+    #remember how everything was generated, to save only what changes
+    level_baseline = [object_state(obj) for obj in level_spawns]
 
-def random_choice_index(chances):  #choose one option from list of chances, returning its index
+def random_choice_index(chances, stream='loot'):  #choose one option from list of chances, returning its index
     #the dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = random_int(stream, 1, sum(chances))
 
     #go through all chances, keeping the sum so far
     running_sum = 0
@@ -590,12 +1226,12 @@ def random_choice_index(chances):  #choose one option from list of chances, retu
             return choice
         choice += 1
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, stream='loot'):
     #choose one option from dictionary of chances, returning its key
     chances = chances_dict.values()
     strings = chances_dict.keys()
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, stream)]
 
 def from_dungeon_level(table):
     #returns a value that depends on level. the table specifies what value occurs after each level, default is 0.
@@ -608,31 +1244,27 @@ def place_objects(room):
     #this is where we decide the chance of each monster or item appearing.
 
     #maximum number of monsters per room
-    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
+    max_monsters = from_dungeon_level(MAX_MONSTERS_TABLE)
 
     #chance of each monster
     monster_chances = {}
-    monster_chances['orc fighter'] = 80  # orc always shows up, even if all other monsters have 0 chance
-    monster_chances['troll'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
+    for (name, table) in MONSTER_CHANCE_TABLES.items():
+        monster_chances[name] = from_dungeon_level(table)
 
     #maximum number of items per room
-    max_items = from_dungeon_level([[1, 1], [2, 4]])
+    max_items = from_dungeon_level(MAX_ITEMS_TABLE)
 
-    #chance of each item (by default they have a chance of 0 at level 1, which then goes up)
+    #chance of each item
     item_chances = {}
-    item_chances['heal'] = 35  # healing potion always shows up, even if all other items have 0 chance
-    item_chances['lightning'] = from_dungeon_level([[25, 4]])
-    item_chances['fireball'] = from_dungeon_level([[25, 6]])
-    item_chances['confuse'] = from_dungeon_level([[10, 2]])
-    item_chances['sword'] = from_dungeon_level([[5, 4]])
-    item_chances['shield'] = from_dungeon_level([[15, 8]])
+    for (name, table) in ITEM_CHANCE_TABLES.items():
+        item_chances[name] = from_dungeon_level(table)
 
     #choose random number of monsters
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+    num_monsters = random_int('loot', 0, max_monsters)
     for i in range(num_monsters):
         #choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = random_int('loot', room.x1 + 1, room.x2 - 1)
+        y = random_int('loot', room.y1 + 1, room.y2 - 1)
 
         #only place it if the tile is not blocked
         if not is_blocked(x, y):
@@ -649,21 +1281,21 @@ def place_objects(room):
 
             elif choice == 'troll':
                 #create a troll
-                combatant_component = Combatant(quantity=1, hp=30, melee_defense=2, melee_power=8, xp=100, death_function=monster_death)
+                combatant_component = Combatant(name='troll', quantity=1, hp=30, melee_defense=2, melee_power=8, xp=100, death_function=monster_death)
                 ai_component = AI_BasicMonster()
 
                 monster_encounter = Object(x, y, troll_tile, 'troll', libtcod.white,
                     blocks=True, first_combatant=combatant_component, ai=ai_component)
 
-            objects.append(monster_encounter)
+            spawn_object(monster_encounter)
 
     #choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = random_int('loot', 0, max_items)
 
     for i in range(num_items):
         #choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = random_int('loot', room.x1 + 1, room.x2 - 1)
+        y = random_int('loot', room.y1 + 1, room.y2 - 1)
 
         #only place it if the tile is not blocked
         if not is_blocked(x, y):
@@ -698,7 +1330,7 @@ def place_objects(room):
                 equipment_component = Equipment(slot='left hand', melee_defense_bonus=1)
                 item = Object(x, y, '[', 'shield', libtcod.darker_orange, equipment=equipment_component)
 
-            objects.append(item)
+            spawn_object(item)
             item.send_to_back()  # items appear below other objects
             item.always_visible = True  # items are visible even out-of-FOV, if in an explored area
 
@@ -730,94 +1362,199 @@ def get_names_under_mouse():
     (x, y) = (mouse.cx, mouse.cy)
 
     #create a list with the names of all objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = []
+    if in_fov(x, y):
+        names = [obj.name for obj in object_index.at(x, y)]
 
     names = ', '.join(names)  # join the names, separated by commas
     return names.capitalize()
 
 
-def render_all():
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute
+def torch_area(x, y):
+    #return the range of columns and rows that can possibly be lit from (x, y)
+    if TORCH_RADIUS <= 0:
+        return (range(MAP_WIDTH), range(MAP_HEIGHT))
+    return (range(max(0, x - TORCH_RADIUS), min(MAP_WIDTH, x + TORCH_RADIUS + 1)),
+        range(max(0, y - TORCH_RADIUS), min(MAP_HEIGHT, y + TORCH_RADIUS + 1)))
+
+
+def in_fov(x, y):
+    #whether a tile was in the player's FOV when it was last computed. this is kept on the
+    #Python side by recompute_fov, so the AI and the drawing code don't have to ask libtcod.
+    return (x, y) in visible_tiles
+
 
+def recompute_fov():
+    #recompute FOV from the player's position and explore what came into view.
+    #returns the tiles that came into view and the ones that went out of it.
+    global fov_recompute, visible_tiles
+    fov_recompute = False
+    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+
+    #copy the FOV out of libtcod at once. only the tiles around the player can be in it,
+    #so there's no need to look at the whole map.
+    fov = libtcod.map_get_fov_bulk(fov_map)
+    (columns, rows) = torch_area(player.x, player.y)
+    now_visible = set()
+    for y in rows:
+        for x in columns:
+            if fov[y * MAP_WIDTH + x]:
+                now_visible.add((x, y))
+
+    shown = now_visible - visible_tiles
+    hidden = visible_tiles - now_visible
+    for (x, y) in shown:
+        level_map.explored[y * MAP_WIDTH + x] = 1
+    visible_tiles = now_visible
+    monster_scheduler.wake_tiles(shown)
+    return (shown, hidden)
+
+
+def render_all():
     if fov_recompute:
         #recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        #go through all tiles, and set their background color according to the FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = libtcod.map_is_in_fov(fov_map, x, y)
-                wall = level_map[x][y].block_sight
-                if not visible:
-                    #if it's not visible right now, the player can only see it if it's explored
-                    if level_map[x][y].explored:
-                        if wall:
-                            libtcod.console_set_char_foreground(con, x, y, color_dark_wall)
-                            libtcod.console_set_char(con, x, y, wall_tile)
-
-                        else:
-                            libtcod.console_set_char_foreground(con, x, y, color_dark_ground)
-                            libtcod.console_set_char(con, x, y, floor_tile)
-                else:
-                    #it's visible
-                    if wall:
-                        libtcod.console_set_char_foreground(con, x, y, color_light_wall)
-                        libtcod.console_set_char(con, x, y, wall_tile)
-                    else:
-                        libtcod.console_set_char_foreground(con, x, y, color_light_ground)
-                        libtcod.console_set_char(con, x, y, floor_tile)
-                    #since it's visible, explore it
-                    level_map[x][y].explored = True
-
-    #draw all objects in the list, except the player. we want it to
-    #always appear over all other objects! so it's drawn later.
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
-
-    #blit the contents of "con" to the root console
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
-
-    #prepare to render the GUI panel
-    libtcod.console_set_default_background(panel, libtcod.black)
-    libtcod.console_clear(panel)
+        profile('fov')
+        (shown, hidden) = recompute_fov()
+        profile('render')
+        map_renderer.show(shown)
+        map_renderer.hide(hidden)
+        compositor.mark(shown)
+        compositor.mark(hidden)
+
+    #redraw what changed, and blit the contents of "con" and "panel" to the root console if they did.
+    #the profile is drawn over the map, so then the map is blitted every frame.
+    if compositor.render_map() or active_profiler is not None:
+        libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+    for (x, y, width, height) in compositor.render_panel():
+        libtcod.console_blit(panel, x, y, width, height, 0, x, PANEL_Y + y)
+
+    if active_profiler is not None:
+        render_profile()
+
+
+def hud_widgets():
+    #the widgets on the panel, as (where it is, the values it shows, the function that draws them). the
+    #values are all a widget depends on, so it's drawn again only when they change.
+    widgets = [
+        ((1, 0, SCREEN_WIDTH - 1, 1), get_names_under_mouse(), render_names),
+        ((MSG_X, 1, MSG_WIDTH, MSG_HEIGHT), len(message_history), render_messages),
+        ((1, PANEL_HEIGHT - 1, BAR_WIDTH, 1), dungeon_level, render_dungeon_level)]
+
+    #a bar for each party member, as many as fit between the names and the dungeon level
+    for (i, member) in enumerate(player.combatant[:PANEL_HEIGHT - 2]):
+        widgets.append(((1, 1 + i, BAR_WIDTH, 1), (member.name, member.hp, member.max_hp), render_member))
+    return widgets
+
+
+def render_names(x, y, width, names_under_mouse):
+    #display names of objects under the mouse
+    libtcod.console_set_default_foreground(panel, libtcod.light_gray)
+    libtcod.console_print(panel, x, y, names_under_mouse)
+
 
+def render_messages(x, y, width, count):
     #print the game messages, one line at a time
-    y = 1
-    for (line, color) in game_msgs:
+    for (line, color) in message_lines(MSG_HEIGHT):
         libtcod.console_set_default_foreground(panel, color)
-        libtcod.console_print(panel, MSG_X, y, line)
+        libtcod.console_print(panel, x, y, line)
         y += 1
 
-    #show the player's stats
-    render_bar(1, 1, BAR_WIDTH, 'HP', player.combatant[0].hp, player.combatant[0].max_hp,
-        libtcod.light_red, libtcod.darker_red)
-    libtcod.console_print(panel, 1, 3, 'Dungeon level ' + str(dungeon_level))
 
-    #display names of objects under the mouse
-    libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-    libtcod.console_print(panel, 1, 0, get_names_under_mouse())
+def render_dungeon_level(x, y, width, level):
+    libtcod.console_set_default_foreground(panel, libtcod.white)
+    libtcod.console_print(panel, x, y, 'Dungeon level ' + str(level))
 
-    #blit the contents of "panel" to the root console
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 
+def render_member(x, y, width, member):
+    (name, hp, max_hp) = member
+    render_bar(x, y, width, name, hp, max_hp, libtcod.light_red, libtcod.darker_red)
 
-def message(new_msg, color=libtcod.white):
-    #split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
 
-    for line in new_msg_lines:
-        #if the buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+def render_profile():
+    #show how long each phase of the last frame took, over the top left of the map
+    libtcod.console_set_default_foreground(0, libtcod.yellow)
+    y = 0
+    for (name, seconds, calls) in active_profiler.last_frame():
+        libtcod.console_print(0, 0, y, '%-9s %7.2f ms %5d calls' % (name, seconds * 1000, calls))
+        y += 1
+
 
-        #add the new line as a tuple, with the text and the color
-        game_msgs.append((line, color))
+def new_message_log(events=()):
+    #the message log only keeps as many events as the panel can show: each takes at least one line.
+    #the deque drops the oldest by itself.
+    return collections.deque(events, MSG_HEIGHT)
+
+
+def message(new_msg, color=libtcod.white):
+    #add a message to the log. it's split among multiple lines only when it's drawn.
+    event = (new_msg, None, None, None, color)
+    game_msgs.append(event)
+    if message_history is not None:
+        message_history.append(event)
+
+
+def log_event(actor, verb, target=None, amount=None, color=libtcod.white):
+    #add an event to the log, kept as its parts: the text (see EVENT_FORMATS) is only made if it's shown
+    event = (actor, verb, target, amount, color)
+    game_msgs.append(event)
+    if message_history is not None:
+        message_history.append(event)
+
+
+def encode_event(event):
+    (actor, verb, target, amount, color) = event
+    w = savefile.SaveWriter()
+    w.string(actor)
+    w.string(verb or '')
+    w.string(target or '')
+    w.pack('?iBBB', amount is not None, amount or 0, color.r, color.g, color.b)
+    return w.getvalue()
+
+def decode_event(data):
+    r = savefile.SaveReader(data)
+    (actor, verb, target) = (r.string(), r.string(), r.string())
+    (has_amount, amount, red, green, blue) = r.unpack('?iBBB')
+    return (actor, verb or None, target or None, amount if has_amount else None, libtcod.Color(red, green, blue))
+
+
+def new_message_history():
+    #start the history of a game over. headless games keep none: nobody can look at
+    #it and it isn't saved, so encoding the events would be wasted.
+    history = None
+    if not headless:
+        history = savefile.Spool(encode_event, decode_event, HISTORY_CHUNK)
+    set_message_history(history)
+
+
+def set_message_history(history):
+    global message_history
+    if message_history is not None:
+        message_history.close()
+    message_history = history
+
+
+def history_length():
+    if message_history is None:
+        return 0
+    return len(message_history)
+
+
+def format_event(event):
+    (actor, verb, target, amount, color) = event
+    if verb is None:
+        return actor  # a plain message
+    text = EVENT_FORMATS[verb].format(actor=actor, target=target, amount=amount)
+    return text[:1].upper() + text[1:]
+
+
+def message_lines(height):
+    #the last lines of the message log, wrapped to the panel's width, with their colors
+    lines = []
+    for event in reversed(game_msgs):
+        lines[0:0] = [(line, event[4]) for line in textwrap.wrap(format_event(event), MSG_WIDTH)]
+        if len(lines) >= height:
+            break
+    return lines[-height:]
 
 
 def player_move_or_attack(dx, dy):
@@ -829,28 +1566,45 @@ def player_move_or_attack(dx, dy):
 
     #try to find an attackable object there
     target = None
-    for object in objects:
-        if object.combatant and object.x == x and object.y == y:
+    for object in object_index.at(x, y):
+        if object.combatant:
             target = object
             break
 
     #attack if target found, move otherwise
     if target is not None:
-        begin_combat(target)
+        begin_combat(player, target)
         # player.combatant[0].melee_attack(target)
     else:
         player.move(dx, dy)
         fov_recompute = True
 
 
-def begin_combat(target):
-    combat_con = libtcod.console_new()
+def make_noise(x, y):
+    #wake up the monsters that can hear something happening at (x, y)
+    monster_scheduler.wake_near(x, y, NOISE_RADIUS)
+
+
+def begin_combat(attacker, defender):
+    #the attacker's turn in a fight: each of its living stacks attacks the defender once, highest
+    #initiative first. the defender strikes back on its own turn.
+    make_noise(defender.x, defender.y)
+    for combatant in sorted(living_combatants(attacker), key=lambda combatant: -combatant.initiative):
+        if not living_combatants(defender):
+            break
+        combatant.attack(defender)
 
 
 def menu(header, options, width):
     if len(options) > 26:
         raise ValueError('Cannot have a menu with more than 26 options.')
 
+    if headless:
+        #nobody to ask, so pick an option at random
+        if len(options) == 0:
+            return None
+        return random_int('agent', 0, len(options) - 1)
+
     #calculate total height for the header (after auto-wrap) and one line per option
     header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
     if header == '':
@@ -881,6 +1635,7 @@ def menu(header, options, width):
     #present the root console to the player and wait for a key-press
     libtcod.console_flush()
     key = libtcod.console_wait_for_keypress(True)
+    invalidate_screen()
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:  # (special case) Alt+Enter: toggle fullscreen
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
@@ -892,6 +1647,47 @@ def menu(header, options, width):
     return None
 
 
+def history_viewer():
+    #page through every message of the game so far, the newest at the bottom. only the chunks of
+    #the history with messages on screen are read back.
+    height = SCREEN_HEIGHT - 2
+    bottom = len(message_history)  # one past the last message shown
+    window = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    while True:
+        #fill the screen upwards, starting with the bottom message
+        lines = []
+        i = bottom
+        while i > 0 and len(lines) < height:
+            i -= 1
+            event = message_history[i]
+            lines[0:0] = [(line, event[4]) for line in textwrap.wrap(format_event(event), SCREEN_WIDTH - 2)]
+
+        libtcod.console_clear(window)
+        for (y, (line, color)) in enumerate(lines[-height:]):
+            libtcod.console_set_default_foreground(window, color)
+            libtcod.console_print(window, 1, y, line)
+        libtcod.console_set_default_foreground(window, libtcod.light_gray)
+        libtcod.console_print(window, 1, SCREEN_HEIGHT - 1, 'Up/Down, PgUp/PgDn: scroll. Any other key: close.')
+        libtcod.console_blit(window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+        libtcod.console_flush()
+
+        key = libtcod.console_wait_for_keypress(True)
+        if key.vk == libtcod.KEY_UP:
+            bottom = max(bottom - 1, min(len(message_history), 1))
+        elif key.vk == libtcod.KEY_DOWN:
+            bottom = min(bottom + 1, len(message_history))
+        elif key.vk == libtcod.KEY_PAGEUP:
+            bottom = max(bottom - height, min(len(message_history), 1))
+        elif key.vk == libtcod.KEY_PAGEDOWN:
+            bottom = min(bottom + height, len(message_history))
+        else:
+            break
+
+    libtcod.console_delete(window)
+    invalidate_screen()
+
+
 def inventory_menu(header):
     #show a menu with each item of the inventory as an option
     if len(inventory) == 0:
@@ -913,6 +1709,12 @@ def inventory_menu(header):
     return inventory[index].item
 
 
+def invalidate_screen():
+    #something was drawn over the screen (e.g. a menu), so the next frame has to draw all of it again
+    if compositor is not None:
+        compositor.invalidate()
+
+
 def msgbox(text, width=50):
     menu(text, [], width)  # use menu() as a sort of "message box"
 
@@ -959,10 +1761,9 @@ def handle_keys():
 
             if key_char == 'g':
                 #pick up an item
-                for object in objects:  # look for an item in the player's tile
-                    if object.x == player.x and object.y == player.y and object.item:
-                        object.item.pick_up()
-                        break
+                for object in object_index.items_at(player.x, player.y):  # look for an item in the player's tile
+                    object.item.pick_up()
+                    break
 
             if key_char == 'i':
                 #show the inventory; if an item is selected, use it
@@ -981,7 +1782,20 @@ def handle_keys():
                 level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
                 msgbox('Character Information\n\nLevel: ' + str(player.level) + '\nExperience: ' + str(player.combatant[0].xp) +
                     '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.combatant[0].max_hp) +
-                    '\nAttack: ' + str(player.combatant[0].power) + '\nDefense: ' + str(player.combatant[0].defense), CHARACTER_SCREEN_WIDTH)
+                    '\nAttack: ' + str(player.combatant[0].melee_power) + '\nDefense: ' + str(player.combatant[0].melee_defense), CHARACTER_SCREEN_WIDTH)
+
+            if key_char == 'h':
+                #show all the messages so far
+                history_viewer()
+
+            if key_char == 'p':
+                #start profiling frames, or stop and save the timings
+                if active_profiler is None:
+                    start_profiling()
+                else:
+                    stop_profiling(PROFILE_FILE)
+                    invalidate_screen()  # erase the profile
+                    message('Frame timings saved to ' + PROFILE_FILE + '.', libtcod.light_gray)
 
             if key_char == '>':
                 #go down stairs, if the player is on them
@@ -1004,16 +1818,16 @@ def check_level_up():
         while choice is None:  # keep asking until a choice is made
             choice = menu('Level up! Choose a stat to raise:\n',
                 ['Constitution (+20 HP, from ' + str(player.combatant[0].max_hp) + ')',
-                'Strength (+1 attack, from ' + str(player.combatant[0].power) + ')',
-                'Agility (+1 defense, from ' + str(player.combatant[0].defense) + ')'], LEVEL_SCREEN_WIDTH)
+                'Strength (+1 attack, from ' + str(player.combatant[0].melee_power) + ')',
+                'Agility (+1 defense, from ' + str(player.combatant[0].melee_defense) + ')'], LEVEL_SCREEN_WIDTH)
 
         if choice == 0:
             player.combatant[0].base_max_hp += 20
             player.combatant[0].hp += 20
         elif choice == 1:
-            player.combatant[0].base_power += 1
+            player.combatant[0].base_melee_power += 1
         elif choice == 2:
-            player.combatant[0].base_defense += 1
+            player.combatant[0].base_melee_defense += 1
 
 
 def player_death(player):
@@ -1030,7 +1844,7 @@ def player_death(player):
 def monster_death(monster):
     #transform it into a nasty corpse! it doesn't block, can't be
     #attacked and doesn't move
-    message('The ' + monster.name + ' is dead! You gain ' + str(monster.combatant[0].xp) + ' experience points.', libtcod.orange)
+    message('The ' + monster.name + ' is dead!', libtcod.orange)
     monster.char = corpse_tile
     monster.color = libtcod.white
     monster.blocks = False
@@ -1043,11 +1857,13 @@ def monster_death(monster):
 def target_tile(max_range=None):
     #return the position of a tile left-clicked in player's FOV (optionally in a range), or (None,None) if right-clicked.
     global key, mouse
+    if headless:
+        return (None, None)  # there's no mouse to click with
     while True:
         #render the screen. this erases the inventory and shows the names of objects under the mouse.
-        libtcod.console_flush()
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
         render_all()
+        libtcod.console_flush()
+        wait_for_input()
 
         (x, y) = (mouse.cx, mouse.cy)
 
@@ -1055,7 +1871,7 @@ def target_tile(max_range=None):
             return (None, None)  # cancel if the player right-clicked or pressed Escape
 
         #accept the target if the player clicked in FOV, and in case a range is specified, if it's in that range
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
+        if (mouse.lbutton_pressed and in_fov(x, y) and
             (max_range is None or player.distance(x, y) <= max_range)):
             return (x, y)
 
@@ -1068,8 +1884,8 @@ def target_monster(max_range=None):
             return None
 
         #return the first clicked monster, otherwise continue looping
-        for obj in objects:
-            if obj.x == x and obj.y == y and obj.combatant and obj != player:
+        for obj in object_index.at(x, y):
+            if obj.combatant and obj != player:
                 return obj
 
 
@@ -1078,8 +1894,8 @@ def closest_monster(max_range):
     closest_enemy = None
     closest_dist = max_range + 1  # start with (slightly more than) maximum range
 
-    for object in objects:
-        if object.combatant and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+    for object in object_index.in_radius(player.x, player.y, max_range):
+        if object.combatant and not object == player and in_fov(object.x, object.y):
             #calculate distance between this object and the player
             dist = player.distance_to(object)
             if dist < closest_dist:  # it's closer, so remember it
@@ -1090,12 +1906,12 @@ def closest_monster(max_range):
 
 def cast_heal():
     #heal the player
-    if player.combatant[0].hp == player.combatant[0].max_hp:
+    if front_combatant(player).hp == front_combatant(player).max_hp:
         message('You are already at full health.', libtcod.red)
         return 'cancelled'
 
     message('Your wounds start to feel better!', libtcod.light_violet)
-    player.combatant[0].heal(HEAL_AMOUNT)
+    front_combatant(player).heal(HEAL_AMOUNT)
 
 
 def cast_lightning():
@@ -1108,7 +1924,27 @@ def cast_lightning():
     #zap it!
     message('A lighting bolt strikes the ' + monster.name + ' with a loud thunder! The damage is '
         + str(LIGHTNING_DAMAGE) + ' hit points.', libtcod.light_blue)
-    monster.combatant[0].take_damage(LIGHTNING_DAMAGE)
+    front_combatant(monster).take_damage(LIGHTNING_DAMAGE, 'lightning bolt')
+    make_noise(monster.x, monster.y)
+
+
+def area_damage(x, y, radius, damage, source):
+    #hit every one of every stack within radius of (x, y) for damage. each stack is worked out in one
+    #go (see spread_damage), so a big group costs no more than a single monster. returns the name (from
+    #before it was hit, as dying renames it) and the hit points taken off everything hit.
+    hit = []
+    for obj in object_index.in_radius(x, y, radius):
+        stacks = living_combatants(obj)
+        if not stacks:
+            continue
+        name = obj.name
+        total = 0
+        for combatant in stacks:
+            (hp, quantity, dealt) = spread_damage(combatant.hp, combatant.quantity, combatant.max_hp, damage)
+            total += dealt
+            combatant.set_health(hp, quantity, source)
+        hit.append((name, total))
+    return hit
 
 
 def cast_fireball():
@@ -1118,11 +1954,10 @@ def cast_fireball():
     if x is None:
         return 'cancelled'
     message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', libtcod.orange)
+    make_noise(x, y)
 
-    for obj in objects:  # damage every combatant in range, including the player
-        if obj.distance(x, y) <= FIREBALL_RADIUS and obj.combatant:
-            message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.orange)
-            obj.combatant[0].take_damage(FIREBALL_DAMAGE)
+    for (name, total) in area_damage(x, y, FIREBALL_RADIUS, FIREBALL_DAMAGE, 'fireball'):  # including the player
+        log_event(name, 'burned', amount=total, color=libtcod.orange)
 
 
 def cast_confuse():
@@ -1139,41 +1974,503 @@ def cast_confuse():
     message('The eyes of the ' + monster.name + ' look vacant, as he starts to stumble around!', libtcod.light_green)
 
 
+SAVE_FILE = 'savegame'
+#2: the whole message history, and a level checksum that covers the objects too. 3: stream positions.
+#4: each autosave journals only the history events since the one before.
+SAVE_VERSION = 4
+
+#changes since the last save are appended to the journal every few turns (see autosave), and the
+#save is written again from scratch once the journal has grown this big
+JOURNAL_FILE = SAVE_FILE + '.journal'
+AUTOSAVE_TURNS = 20
+AUTOSAVE_COMPACT_SIZE = 64 * 1024
+
+#kinds of record the game is split into for autosaves. like SAVED_FUNCTIONS, only ever add to the end.
+RECORD_STATE, RECORD_PLAYER, RECORD_INVENTORY, RECORD_MESSAGES, RECORD_EXPLORED, RECORD_OTHERS, RECORD_SPAWN, RECORD_HISTORY, RECORD_RANDOM = range(9)
+
+#functions that objects refer to (use_function, death_function) are saved as their position in this
+#list, and AI components as their class's. only ever add to the end, or old saves will mix them up.
+SAVED_FUNCTIONS = [None, cast_heal, cast_lightning, cast_fireball, cast_confuse, player_death, monster_death]
+SAVED_AIS = [None, AI_BasicMonster, AI_ConfusedMonster]
+
+#the stats of a Combatant saved as 32-bit integers, in file order
+SAVED_COMBATANT_STATS = ['quantity', 'hp', 'base_max_hp', 'mp', 'base_max_mp', 'base_melee_power', 'base_melee_defense',
+    'base_ranged_power', 'base_ranged_defense', 'base_magic_power', 'base_magic_defense', 'base_initiative', 'base_luck', 'xp']
+
+
+def write_char(w, char):
+    #an object's character is either a tile number or a one-letter string
+    if isinstance(char, str):
+        w.pack('?i', True, ord(char))
+    else:
+        w.pack('?i', False, char)
+
+def read_char(r):
+    (is_letter, char) = r.unpack('?i')
+    if is_letter:
+        return chr(char)
+    return char
+
+
+def write_ai(w, ai):
+    w.pack('B', SAVED_AIS.index(ai.__class__ if ai is not None else None))
+    if isinstance(ai, AI_ConfusedMonster):
+        w.pack('h', ai.num_turns)
+        write_ai(w, ai.old_ai)
+
+def read_ai(r):
+    ai_class = SAVED_AIS[r.unpack('B')[0]]
+    if ai_class is AI_ConfusedMonster:
+        (num_turns,) = r.unpack('h')
+        return AI_ConfusedMonster(read_ai(r), num_turns)
+    if ai_class is not None:
+        return ai_class()
+    return None
+
+
+def write_object(w, obj):
+    #everything about an object, for objects that can't be made again from the seed
+    w.pack('hh', obj.x, obj.y)
+    write_char(w, obj.char)
+    w.string(obj.name)
+    w.pack('BBB??H', obj.color.r, obj.color.g, obj.color.b, obj.blocks, obj.always_visible, getattr(obj, 'level', 0))
+
+    w.pack('B', len(obj.combatant))
+    for combatant in obj.combatant:
+        w.string(combatant.name)
+        w.pack('%di' % len(SAVED_COMBATANT_STATS), *[getattr(combatant, stat) for stat in SAVED_COMBATANT_STATS])
+        w.pack('B', SAVED_FUNCTIONS.index(combatant.death_function))
+
+    write_ai(w, obj.ai)
+
+    w.pack('?', obj.item is not None)
+    if obj.item:
+        w.pack('B', SAVED_FUNCTIONS.index(obj.item.use_function))
+
+    w.pack('?', obj.equipment is not None)
+    if obj.equipment:
+        w.string(obj.equipment.slot)
+        w.pack('?', obj.equipment.is_equipped)
+        w.pack('%di' % len(EQUIPMENT_STATS), *[getattr(obj.equipment, stat + '_bonus') for stat in EQUIPMENT_STATS])
+
+def read_object(r):
+    (x, y) = r.unpack('hh')
+    char = read_char(r)
+    name = r.string()
+    (red, green, blue, blocks, always_visible, level) = r.unpack('BBB??H')
+
+    combatants = []
+    for i in range(r.unpack('B')[0]):
+        combatant = Combatant(r.string())
+        for (stat, value) in zip(SAVED_COMBATANT_STATS, r.unpack('%di' % len(SAVED_COMBATANT_STATS))):
+            setattr(combatant, stat, value)
+        combatant.death_function = SAVED_FUNCTIONS[r.unpack('B')[0]]
+        combatants.append(combatant)
+
+    ai = read_ai(r)
+
+    item = None
+    if r.unpack('?')[0]:
+        item = Item(use_function=SAVED_FUNCTIONS[r.unpack('B')[0]])
+
+    equipment = None
+    if r.unpack('?')[0]:
+        equipment = Equipment(r.string())
+        (equipment.is_equipped,) = r.unpack('?')
+        for (stat, value) in zip(EQUIPMENT_STATS, r.unpack('%di' % len(EQUIPMENT_STATS))):
+            setattr(equipment, stat + '_bonus', value)
+
+    obj = Object(x, y, char, name, libtcod.Color(red, green, blue), blocks=blocks, always_visible=always_visible,
+        first_combatant=combatants[0] if combatants else None, ai=ai, item=item, equipment=equipment)
+    for combatant in combatants[1:]:
+        obj.add_combatant(combatant)
+    if level:
+        obj.level = level
+    return obj
+
+
+def write_state(w, state):
+    #an object_state tuple, for generated objects that changed
+    (x, y, char, name, blocks, has_ai, combatants) = state
+    w.pack('hh', x, y)
+    write_char(w, char)
+    w.string(name)
+    w.pack('??B', blocks, has_ai, len(combatants))
+    for (hp, quantity) in combatants:
+        w.pack('ii', hp, quantity)
+
+def read_state(r):
+    (x, y) = r.unpack('hh')
+    char = read_char(r)
+    name = r.string()
+    (blocks, has_ai, count) = r.unpack('??B')
+    combatants = tuple(r.unpack('ii') for i in range(count))
+    return (x, y, char, name, blocks, has_ai, combatants)
+
+
+def write_objects(w, objs):
+    w.pack('H', len(objs))
+    for obj in objs:
+        write_object(w, obj)
+
+def read_objects(r):
+    return [read_object(r) for i in range(r.unpack('H')[0])]
+
+
+def write_messages(w, msgs):
+    #events are saved as their text
+    w.pack('H', len(msgs))
+    for event in msgs:
+        color = event[4]
+        w.string(format_event(event))
+        w.pack('BBB', color.r, color.g, color.b)
+
+def read_messages(r):
+    msgs = new_message_log()
+    for i in range(r.unpack('H')[0]):
+        line = r.string()
+        msgs.append((line, None, None, None, libtcod.Color(*r.unpack('BBB'))))
+    return msgs
+
+
+def write_stream_draws(w, draws):
+    w.pack('B', len(draws))
+    for (stream, count) in sorted(draws.items()):
+        w.string(stream)
+        w.pack('I', count)
+
+def read_stream_draws(r):
+    draws = {}
+    for i in range(r.unpack('B')[0]):
+        stream = r.string()
+        (draws[stream],) = r.unpack('I')
+    return draws
+
+
+def write_events(w, events):
+    #events of the message history, as they're kept in it
+    w.pack('I', len(events))
+    for event in events:
+        w.blob(encode_event(event))
+
+def read_events(r):
+    return [decode_event(r.blob()) for i in range(r.unpack('I')[0])]
+
+
+def encode_record(write, value):
+    w = savefile.SaveWriter()
+    write(w, value)
+    return w.getvalue()
+
+
+def game_records():
+    #the game split into records keyed by (kind, id), each encoded on its own, so that autosave can
+    #tell which ones changed. generated objects that are as they were made have no record.
+    (changed, others) = level_delta()
+    records = {
+        (RECORD_STATE, 0): encode_record(savefile.SaveWriter.string, game_state),
+        (RECORD_PLAYER, 0): encode_record(write_object, player),
+        (RECORD_INVENTORY, 0): encode_record(write_objects, inventory),
+        (RECORD_MESSAGES, 0): encode_record(write_messages, game_msgs),
+        (RECORD_EXPLORED, 0): encode_record(savefile.SaveWriter.blob, level_map.pack_explored()),
+        (RECORD_OTHERS, 0): encode_record(write_objects, others),
+        (RECORD_RANDOM, 0): encode_record(write_stream_draws, rng_draws)}
+    for (spawn_id, state) in changed.items():
+        w = savefile.SaveWriter()
+        w.pack('?', state is not None)
+        if state is not None:
+            write_state(w, state)
+        records[(RECORD_SPAWN, spawn_id)] = w.getvalue()
+    return records
+
+
+def apply_record(kind, id, data):
+    #bring the game up to date with a record from game_records, or with its removal (data is None)
+    global player, inventory, game_msgs, game_state
+    if kind == RECORD_SPAWN:
+        obj = level_spawns[id]
+        state = level_baseline[id]  # no record: it's back the way it was made
+        if data is not None:
+            r = savefile.SaveReader(data)
+            state = read_state(r) if r.unpack('?')[0] else None
+        if state is None:
+            if obj in objects:
+                remove_object(obj)
+        else:
+            if obj not in objects:
+                add_object(obj)
+            set_object_state(obj, state)
+            if not obj.combatant:
+                obj.send_to_back()
+        return
+
+    r = savefile.SaveReader(data)
+    if kind == RECORD_STATE:
+        game_state = r.string()
+    elif kind == RECORD_PLAYER:
+        remove_object(player)
+        player = read_object(r)
+        add_object(player)
+    elif kind == RECORD_INVENTORY:
+        inventory = read_objects(r)
+    elif kind == RECORD_MESSAGES:
+        game_msgs = read_messages(r)
+    elif kind == RECORD_HISTORY:  # more events, following on from those already there
+        if message_history is not None:
+            for event in read_events(r):
+                message_history.append(event)
+    elif kind == RECORD_EXPLORED:
+        level_map.unpack_explored(r.blob())
+    elif kind == RECORD_RANDOM:
+        set_stream_draws(read_stream_draws(r))
+    elif kind == RECORD_OTHERS:
+        for obj in level_delta()[1]:
+            remove_object(obj)
+        for obj in read_objects(r):
+            add_object(obj)
+
+
+def autosave():
+    #append the records that changed since the last save or autosave to the journal, so an autosave
+    #costs about as much as what happened since. once the journal is big, save everything instead.
+    global saved_records, journaled_history
+    journal = savefile.Journal(JOURNAL_FILE)
+    if not saved_records or journal.size() > AUTOSAVE_COMPACT_SIZE:
+        save_game()
+        return
+
+    records = game_records()
+    changes = [(key, data) for (key, data) in records.items() if saved_records.get(key) != data]
+    changes += [(key, None) for key in saved_records if key not in records]
+    #the history only grows, so it isn't one of the records: just the events since the last autosave are added
+    if history_length() > journaled_history:
+        changes.append(((RECORD_HISTORY, 0), encode_record(write_events,
+            [message_history[i] for i in range(journaled_history, history_length())])))
+    if not changes:
+        return
+
+    w = savefile.SaveWriter()
+    w.pack('H', len(changes))
+    for ((kind, id), data) in sorted(changes, key=lambda change: change[0]):
+        w.pack('BH?', kind, id, data is not None)
+        if data is not None:
+            w.blob(data)
+    journal.append(w.getvalue())
+    saved_records = records
+    journaled_history = history_length()
+
+
+def replay_journal(save_data):
+    #apply the autosaves made since a save was written, oldest first. only the last version of each
+    #record matters, so they're merged before anything is decoded. the history is the exception: each
+    #autosave has only its new events, so all of them are added, in order.
+    records = {}
+    events = []
+    for entry in savefile.Journal(JOURNAL_FILE).read(save_data):
+        r = savefile.SaveReader(entry)
+        for i in range(r.unpack('H')[0]):
+            (kind, id, present) = r.unpack('BH?')
+            data = r.blob() if present else None
+            if kind == RECORD_HISTORY:
+                events.append(data)
+            else:
+                records[(kind, id)] = data
+    for ((kind, id), data) in sorted(records.items(), key=lambda record: record[0]):
+        apply_record(kind, id, data)
+    for data in events:
+        apply_record(RECORD_HISTORY, 0, data)
+
+
+def level_checksum():
+    #a checksum of the level as it was generated: its layout, and everything that was placed on it
+    w = savefile.SaveWriter()
+    w.blob(level_map.blocked)
+    for state in level_baseline:
+        write_state(w, state)
+    return savefile.checksum(w.getvalue())
+
+
 def save_game():
-    #open a new empty shelve (possibly overwriting an old one) to write the game data
-    filehandle = shelve.open('savegame', 'n')
-    filehandle['map'] = level_map
-    filehandle['objects'] = objects
-    filehandle['player_index'] = objects.index(player)  # index of player in objects list
-    filehandle['stairs_index'] = objects.index(stairs)  # same for the stairs
-    filehandle['inventory'] = inventory
-    filehandle['game_msgs'] = game_msgs
-    filehandle['game_state'] = game_state
-    filehandle['dungeon_level'] = dungeon_level
-    filehandle.close()
+    #write the game data to a binary save file, replacing the old one only once it's complete.
+    #the level itself isn't stored: it's made again from the seed, so only what changed is saved.
+    #this also starts a new, empty autosave journal.
+    global saved_records, journaled_history, autosave_countdown
+    (changed, others) = level_delta()
+    w = savefile.SaveWriter(SAVE_VERSION)
+    w.pack('IH', game_seed, dungeon_level)
+    w.string(game_state)
+
+    #the explored tiles, and a checksum of the level to check that it comes out the same when it's made again
+    w.blob(level_map.pack_explored())
+    w.pack('I', level_checksum())
+
+    w.pack('H', len(changed))
+    for (spawn_id, state) in sorted(changed.items()):
+        w.pack('H?', spawn_id, state is not None)
+        if state is not None:
+            write_state(w, state)
+
+    write_objects(w, others)
+
+    write_object(w, player)
+    w.pack('B', len(inventory))
+    for obj in inventory:
+        write_object(w, obj)
+
+    write_messages(w, game_msgs)
+    if message_history is not None:
+        message_history.write(w)
+    else:
+        w.pack('III', HISTORY_CHUNK, 0, 0)  # an empty history
+    write_stream_draws(w, rng_draws)
+
+    w.save(SAVE_FILE)
+    savefile.Journal(JOURNAL_FILE).reset(w.getvalue())
+    journaled_history = history_length()
+    saved_records = game_records()
+    autosave_countdown = AUTOSAVE_TURNS
+
+#what load_game replaces before it can tell whether the save matches the level made from its seed
+LOADED_GLOBALS = ['player', 'inventory', 'game_msgs', 'game_state', 'dungeon_level', 'game_seed', 'rngs', 'rng_draws',
+    'level_map', 'objects', 'object_index', 'stairs', 'level_spawns', 'level_baseline']
 
 def load_game():
-    #open the previously saved shelve and load the game data
-    global level_map, objects, player, stairs, inventory, game_msgs, game_state, dungeon_level
-
-    filehandle = shelve.open('savegame', 'r')
-    level_map = filehandle['map']
-    objects = filehandle['objects']
-    player = objects[filehandle['player_index']]  # get index of player in objects list and access it
-    stairs = objects[filehandle['stairs_index']]  # same for the stairs
-    inventory = filehandle['inventory']
-    game_msgs = filehandle['game_msgs']
-    game_state = filehandle['game_state']
-    dungeon_level = filehandle['dungeon_level']
-    file.close()
+    #read back a save file written by save_game, and the autosaves made since
+    global player, inventory, game_msgs, game_state, dungeon_level, rngs
+
+    r = savefile.load(SAVE_FILE, SAVE_VERSION)
+    if r.version < SAVE_VERSION:
+        raise savefile.SaveError('save file version ' + str(r.version) + ' is too old for this game')
+    (seed, level) = r.unpack('IH')
+    state = r.string()
+    explored = r.blob()
+    (layout_checksum,) = r.unpack('I')
+
+    changed = {}
+    for i in range(r.unpack('H')[0]):
+        (spawn_id, present) = r.unpack('H?')
+        changed[spawn_id] = read_state(r) if present else None
+    others = read_objects(r)
+
+    loaded_player = read_object(r)
+    loaded_inventory = [read_object(r) for i in range(r.unpack('B')[0])]
+    msgs = read_messages(r)
+    history = savefile.Spool(encode_event, decode_event, HISTORY_CHUNK)
+    history.read(r)
+    draws = read_stream_draws(r)
+
+    #everything was read. make the level again and check it before the current game is let go of,
+    #so that if it doesn't match, the game goes on as it was
+    previous = dict((name, globals()[name]) for name in LOADED_GLOBALS)
+    try:
+        rngs = {}  # the current game's generators are kept until the level checks out
+        seed_game(seed)
+        player = loaded_player
+        inventory = loaded_inventory
+        game_msgs = msgs
+        game_state = state
+        dungeon_level = level
+
+        (x, y) = (player.x, player.y)
+        make_map()
+        if level_checksum() != layout_checksum:
+            raise savefile.SaveError('the level came out differently than when it was saved')
+    except:
+        for rng in rngs.values():
+            libtcod.random_delete(rng)
+        globals().update(previous)
+        history.close()
+        raise
+
+    #the current game is gone for good now. bring the level back to how it was.
+    for rng in previous['rngs'].values():
+        libtcod.random_delete(rng)
+    set_message_history(history)
+    object_index.move(player, x, y)
+    level_map.unpack_explored(explored)
+    apply_level_delta(changed, others)
+    set_stream_draws(draws)
+    replay_journal(r.data)
+
+    #fold the journal into a new save. that also gets rid of an entry cut short by a crash, which
+    #would otherwise stay at the end of the journal and hide every autosave appended after it.
+    save_game()
 
     initialize_fov()
 
 
-def new_game():
-
-    global player, inventory, game_msgs, game_state, dungeon_level
+def stream_seed(stream, level=0):
+    #derive the seed of a random stream (on some dungeon level) from the game's seed
+    seed = game_seed & 0xffffffff
+    for c in stream + ':' + str(level):
+        seed = (seed * 31 + ord(c)) & 0xffffffff
+    #mix the bits, so that similar names and levels give unrelated seeds
+    seed ^= seed >> 16
+    seed = (seed * 0x45d9f3b) & 0xffffffff
+    seed ^= seed >> 16
+    return seed
+
+
+def seed_stream(stream, level=0):
+    #(re)start a random stream from its seed
+    if stream in rngs:
+        libtcod.random_delete(rngs[stream])
+    rngs[stream] = libtcod.random_new_from_seed(stream_seed(stream, level))
+    rng_draws[stream] = 0
+
+
+def set_stream_draws(draws):
+    #move the streams on to where they were after the given numbers of draws since they were seeded.
+    #libtcod's generators can't be saved, so this is how a loaded game goes on drawing the same
+    #numbers as if it had never stopped. every draw takes one number from a generator, whatever its range.
+    for (stream, count) in draws.items():
+        if stream in rngs:
+            while rng_draws[stream] < count:
+                random_int(stream, 0, 1)
+
+
+def seed_game(seed):
+    #give each random stream its own generator, seeded from the game's seed, so a game can be replayed
+    #and the random numbers used for one thing (say, a monster's confusion) don't change the others.
+    #saves keep how far each stream got (see set_stream_draws), so loading doesn't start them over. what
+    #the monster scheduler knows isn't saved, though: after loading, every monster starts asleep, so a
+    #monster that was awake out of sight can act differently than in a game that was never saved.
+    global game_seed, rngs, rng_draws
+    for rng in rngs.values():
+        libtcod.random_delete(rng)
+    game_seed = seed
+    rngs = {}
+    rng_draws = {}
+    for stream in RNG_STREAMS:
+        seed_stream(stream)
+
+
+def random_int(stream, mi, ma):
+    #a random integer between mi and ma (inclusive) from the given stream. streams that haven't been
+    #seeded yet (e.g. in the main menu) use libtcod's default generator.
+    if stream not in rngs:
+        return libtcod.random_get_int(0, mi, ma)
+    rng_draws[stream] += 1
+    return libtcod.random_get_int(rngs[stream], mi, ma)
+
+
+def random_float(stream, mi, ma):
+    if stream not in rngs:
+        return libtcod.random_get_float(0, mi, ma)
+    rng_draws[stream] += 1
+    return libtcod.random_get_float(rngs[stream], mi, ma)
+
+
+def new_game(seed=None):
+    #start a new game. without a seed, a random one is picked (and kept in the save)
+    if seed is None:
+        seed = libtcod.random_get_int(0, 0, 0x7fffffff)
+    seed_game(seed)
+
+    global player, inventory, game_msgs, game_state, dungeon_level, saved_records, journaled_history
     global key, mouse
+    saved_records = {}  # nothing saved yet, so the first autosave writes a whole save
+    journaled_history = 0
 
     #create object representing the player
     fighter = Combatant(name='Fred', hp=100, melee_defense=1, melee_power=3, xp=0, death_function=player_death)
@@ -1196,7 +2493,8 @@ def new_game():
     inventory = []
 
     #create the list of game messages and their colors, starts empty
-    game_msgs = []
+    game_msgs = new_message_log()
+    new_message_history()
 
     #a warm welcoming message!
     message('Pre-Alpha.', libtcod.red)
@@ -1216,25 +2514,44 @@ def next_level():
     #advance to the next level
     global player, dungeon_level
     message('You take a moment to rest, and recover your strength.', libtcod.light_violet)
-    player.combatant[0].heal(player.combatant[0].max_hp / 2)  # heal the player by 50%
+    front_combatant(player).heal(front_combatant(player).max_hp / 2)  # heal the player by 50%
 
     dungeon_level += 1
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
     make_map()  # create a fresh new level!
     initialize_fov()
 
+    #the journal can't carry over to a new level, so start over with a whole save
+    if not headless:
+        save_game()
+
 
 def initialize_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, visible_tiles, player_distances, monster_scheduler, map_renderer, compositor
     fov_recompute = True
+    visible_tiles = set()
 
-    #create the FOV map, according to the generated map
+    #create the FOV map, according to the generated map, setting all of its cells at once
     fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not level_map[x][y].block_sight, not level_map[x][y].blocked)
+    libtcod.map_set_properties_bulk(fov_map, level_map.transparent(), level_map.walkable())
+
+    #monsters find their way to the player over the same map
+    if player_distances is not None:
+        player_distances.delete()
+    player_distances = DistanceField(fov_map)
+
+    #every monster starts asleep, and the ones in view wake up when FOV is first computed
+    monster_scheduler = MonsterScheduler(objects)
 
     libtcod.console_clear(con)  # unexplored areas start black (which is the default background color)
+    map_renderer = MapRenderer(level_map)
+    compositor = Compositor()
+
+
+def wait_for_input():
+    #the game is turn-based, so nothing changes on screen until there's a key press or the mouse does
+    #something: sleep until then instead of drawing frames
+    libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse, False)
 
 
 def play_game():
@@ -1246,19 +2563,20 @@ def play_game():
 
     while not libtcod.console_is_window_closed():
         #render the screen
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
+        profile('render')
         render_all()
 
+        profile('flush')
         libtcod.console_flush()
 
         #level up if needed
+        profile('level up')
         check_level_up()
 
-        #erase all objects at their old locations, before they move
-        for object in objects:
-            object.clear()
-
-        #handle keys and exit game if needed
+        #sleep until there's input, then handle keys and exit game if needed
+        profile('wait')
+        wait_for_input()
+        profile('input')
         player_action = handle_keys()
         if player_action == 'exit':
             save_game()
@@ -1266,13 +2584,123 @@ def play_game():
 
         #let monsters take their turn
         if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+            profile('ai')
+            monsters_take_turns()
+            profile('autosave')
+            count_autosave_turn()
+        end_profile_frame()
+
+
+def start_profiling():
+    global active_profiler
+    active_profiler = profiler.Profiler()
+
+
+def stop_profiling(path):
+    #stop profiling and write what was recorded to path (CSV or JSON, see Profiler.dump)
+    global active_profiler
+    active_profiler.dump(path)
+    active_profiler.close()
+    active_profiler = None
+
+
+def profile(phase):
+    #the frame moves on to another phase, if frames are being profiled
+    if active_profiler is not None:
+        active_profiler.phase(phase)
+
+
+def end_profile_frame():
+    if active_profiler is not None:
+        active_profiler.end_frame()
+
+
+def count_autosave_turn():
+    global autosave_countdown
+    autosave_countdown -= 1
+    if autosave_countdown <= 0:
+        autosave_countdown = AUTOSAVE_TURNS
+        autosave()
+
+
+def monsters_take_turns():
+    player_distances.update(player.x, player.y)
+    monster_scheduler.take_turns()
+
+
+class RandomAgent:
+    #plays in place of the keyboard in headless games. it picks up whatever it stands on, goes down
+    #the stairs when it's on them, and otherwise walks towards them, with some random steps thrown in.
+    def __init__(self, wander=0.25):
+        self.wander = wander
+        self.path = None
+        self.path_map = None
+
+    def choose_action(self):
+        if object_index.items_at(player.x, player.y) and len(inventory) < 26:
+            return ('pickup',)
+        if stairs.x == player.x and stairs.y == player.y:
+            return ('descend',)
+
+        if random_float('agent', 0, 1) < self.wander:
+            (dx, dy) = (random_int('agent', -1, 1), random_int('agent', -1, 1))
+            if dx == 0 and dy == 0:
+                return ('wait',)
+            return ('move', dx, dy)
+
+        #the path is made on the level's FOV map, so start a new one on every level
+        if self.path_map is not fov_map:
+            if self.path is not None:
+                libtcod.path_delete(self.path)
+            self.path = libtcod.path_new_using_map(fov_map)
+            self.path_map = fov_map
+        if libtcod.path_compute(self.path, player.x, player.y, stairs.x, stairs.y) and libtcod.path_size(self.path) > 0:
+            (x, y) = libtcod.path_get(self.path, 0)
+            return ('move', x - player.x, y - player.y)
+        return ('wait',)
+
+
+def perform_action(action):
+    #carry out an action chosen by an agent, the same way handle_keys does for a key press
+    if action[0] == 'move':
+        player_move_or_attack(action[1], action[2])
+
+    elif action[0] == 'pickup':
+        for object in object_index.items_at(player.x, player.y):
+            object.item.pick_up()
+            break
+        return 'didnt-take-turn'
+
+    elif action[0] == 'descend':
+        if stairs.x == player.x and stairs.y == player.y:
+            next_level()
+        return 'didnt-take-turn'
+
+
+def play_headless(agent, max_turns=1000):
+    #play without a window: the agent stands in for the keyboard, nothing is rendered and there's no
+    #frame rate limit. stops when the player dies or after max_turns; returns the number of turns played.
+    turns = 0
+    while game_state == 'playing' and turns < max_turns:
+        if fov_recompute:
+            profile('fov')
+            recompute_fov()
+
+        #level up if needed
+        profile('level up')
+        check_level_up()
+
+        profile('agent')
+        if perform_action(agent.choose_action()) != 'didnt-take-turn':
+            turns += 1
+            profile('ai')
+            monsters_take_turns()
+        end_profile_frame()
+    return turns
 
 
 def main_menu():
-    if (libtcod.random_get_int(0, 0, 1) == 0):
+    if (random_int('cosmetic', 0, 1) == 0):
         img = libtcod.image_load('menu_background.png')
     else:
         img = libtcod.image_load('menu_background2.png')
@@ -1304,19 +2732,50 @@ def main_menu():
         elif choice == 2:  # quit
             break
 
-#libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-#libtcod.console_set_custom_font('oryx_tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
-libtcod.console_set_custom_font('pr_tileset_32x32.bmp', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 40, 40)
-
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False, libtcod.RENDERER_SDL)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-#libtcod.console_map_ascii_codes_to_font(256, 32, 0, 5)  #map all characters in 1st row
-#libtcod.console_map_ascii_codes_to_font(256+32, 32, 0, 6)  #map all characters in 2nd row
-
-libtcod.console_map_ascii_codes_to_font(0, 40 * 40, 0, 0)
-
-
-main_menu()
+def init_console():
+    global con, panel
+    #libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    #libtcod.console_set_custom_font('oryx_tiles.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 32, 12)
+    libtcod.console_set_custom_font('pr_tileset_32x32.bmp', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD, 40, 40)
+
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False, libtcod.RENDERER_SDL)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+    #libtcod.console_map_ascii_codes_to_font(256, 32, 0, 5)  #map all characters in 1st row
+    #libtcod.console_map_ascii_codes_to_font(256+32, 32, 0, 6)  #map all characters in 2nd row
+
+    libtcod.console_map_ascii_codes_to_font(0, 40 * 40, 0, 0)
+
+
+def init_headless():
+    #set up to play without a window (see play_headless). libtcod's drawing and input calls do nothing.
+    global con, panel, headless
+    headless = True
+    libtcod.sys_set_headless(True)
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+
+if __name__ == '__main__':
+    if '--headless' in sys.argv[1:]:
+        #e.g. "partyrogue.py --headless 5000" plays a 5000-turn game with the random agent.
+        #"--profile turns.json" also saves how long each part of every turn took.
+        args = [arg for arg in sys.argv[1:] if arg != '--headless']
+        profile_path = None
+        if '--profile' in args:
+            i = args.index('--profile')
+            profile_path = args[i + 1]
+            del args[i:i + 2]
+        init_headless()
+        new_game()
+        if profile_path:
+            start_profiling()
+        turns = play_headless(RandomAgent(), int(args[0]) if args else 1000)
+        if profile_path:
+            stop_profiling(profile_path)
+        print('Played ' + str(turns) + ' turns, reached dungeon level ' + str(dungeon_level) + '.')
+    else:
+        init_console()
+        main_menu()
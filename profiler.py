@@ -0,0 +1,90 @@
+#
+# per-frame profiling: how long each phase of a frame (or headless turn) takes,
+# and how many calls it makes into libtcod. frames can be dumped as CSV or JSON.
+#
+
+import collections
+import csv
+import json
+import time
+
+import libtcodpy as libtcod
+
+
+clock = getattr(time, 'perf_counter', time.time)  # Python 3.3+
+
+
+def open_csv(path):
+    #Python 2's csv module writes its own line endings, so it needs a binary file
+    if str is bytes:
+        return open(path, 'wb')
+    return open(path, 'w', newline='')
+
+
+class Profiler:
+    #call phase() at the start of every phase and end_frame() at the end of the frame. the last
+    #max_frames frames are kept, each as a list of (phase, seconds, libtcod calls).
+    def __init__(self, max_frames=10000):
+        self.frames = collections.deque(maxlen=max_frames)
+        self.current = collections.OrderedDict()
+        self.phase_name = None
+        self.started = 0
+        self.calls = 0
+        libtcod.sys_set_call_counting(True)
+
+    def call_count(self):
+        return sum(libtcod.sys_get_call_counts().values())
+
+    def phase(self, name):
+        #end the current phase, if any, and start the named one. a phase that comes up
+        #more than once in a frame adds up.
+        now = clock()
+        calls = self.call_count()
+        if self.phase_name is not None:
+            (seconds, count) = self.current.get(self.phase_name, (0.0, 0))
+            self.current[self.phase_name] = (seconds + now - self.started, count + calls - self.calls)
+        self.phase_name = name
+        self.started = now
+        self.calls = calls
+
+    def end_frame(self):
+        self.phase(None)
+        self.frames.append([(name, seconds, calls) for (name, (seconds, calls)) in self.current.items()])
+        self.current = collections.OrderedDict()
+
+    def last_frame(self):
+        if not self.frames:
+            return []
+        return self.frames[-1]
+
+    def phase_names(self):
+        #every phase seen, in the order they first came up
+        names = collections.OrderedDict()
+        for frame in self.frames:
+            for (name, seconds, calls) in frame:
+                names[name] = True
+        return list(names)
+
+    def dump(self, path):
+        #write the frames to path: CSV (one row per frame, with the time in milliseconds and the
+        #libtcod calls of every phase) if it ends in .csv, otherwise JSON, which also has the number
+        #of calls to each libtcod function
+        names = self.phase_names()
+        if path.endswith('.csv'):
+            with open_csv(path) as f:
+                writer = csv.writer(f)
+                writer.writerow(['frame'] + [name + ' ms' for name in names] + [name + ' calls' for name in names])
+                for (i, frame) in enumerate(self.frames):
+                    phases = dict((name, (seconds, calls)) for (name, seconds, calls) in frame)
+                    writer.writerow([i] + ['%.3f' % (phases.get(name, (0.0, 0))[0] * 1000) for name in names] +
+                        [phases.get(name, (0.0, 0))[1] for name in names])
+        else:
+            with open(path, 'w') as f:
+                json.dump({
+                    'phases': names,
+                    'frames': [dict((name, {'ms': seconds * 1000, 'calls': calls}) for (name, seconds, calls) in frame)
+                        for frame in self.frames],
+                    'calls': libtcod.sys_get_call_counts()}, f, indent=1, sort_keys=True)
+
+    def close(self):
+        libtcod.sys_set_call_counting(False)
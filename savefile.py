@@ -0,0 +1,275 @@
+#
+# binary save files: a magic string and format version, followed by values
+# packed with struct (little-endian). the game decides what goes in them.
+# a save can be followed by a journal of changes appended to it since.
+# also spools, for logs that are too long to keep in memory.
+#
+
+import os
+import struct
+import tempfile
+import zlib
+
+
+MAGIC = b'PRSV'
+JOURNAL_MAGIC = b'PRJL'
+
+
+class SaveError(Exception):
+    #the file isn't a save, is damaged, or is from a newer version of the game
+    pass
+
+
+def to_str(data):
+    #utf-8 bytes to the native str type (bytes on Python 2, text on Python 3)
+    if str is bytes:
+        return data
+    return data.decode('utf-8')
+
+
+def checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class SaveWriter:
+    #collects packed values in memory, to be written out all at once by save(). without
+    #a version there's no header, for records that are stored inside something else.
+    def __init__(self, version=None):
+        self.parts = []
+        if version is not None:
+            self.parts = [MAGIC, struct.pack('<H', version)]
+
+    def pack(self, fmt, *values):
+        self.parts.append(struct.pack('<' + fmt, *values))
+
+    def string(self, text):
+        data = text.encode('utf-8')
+        self.pack('H', len(data))
+        self.parts.append(data)
+
+    def blob(self, data):
+        self.pack('I', len(data))
+        self.parts.append(bytes(data))
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+    def save(self, path):
+        write_atomic(path, self.getvalue())
+
+
+class SaveReader:
+    #reads back the values of a SaveWriter, in the same order
+    def __init__(self, data, max_version=None):
+        self.data = data
+        self.pos = 0
+        self.version = None
+        if max_version is None:
+            return
+        if data[:len(MAGIC)] != MAGIC:
+            raise SaveError('not a save file')
+        self.pos = len(MAGIC)
+        (self.version,) = self.unpack('H')
+        if self.version > max_version:
+            raise SaveError('save file version ' + str(self.version) + ' is newer than this game')
+
+    def unpack(self, fmt):
+        #returns a tuple, even for a single value
+        s = struct.Struct('<' + fmt)
+        if self.pos + s.size > len(self.data):
+            raise SaveError('save file is truncated')
+        values = s.unpack_from(self.data, self.pos)
+        self.pos += s.size
+        return values
+
+    def raw(self, length):
+        if self.pos + length > len(self.data):
+            raise SaveError('save file is truncated')
+        data = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return data
+
+    def string(self):
+        (length,) = self.unpack('H')
+        return to_str(self.raw(length))
+
+    def blob(self):
+        (length,) = self.unpack('I')
+        return self.raw(length)
+
+
+def load(path, max_version):
+    if not os.path.exists(path) and os.path.exists(path + '.bak'):
+        path += '.bak'  # write_atomic was interrupted before the new save was moved in place
+    f = open(path, 'rb')
+    try:
+        return SaveReader(f.read(), max_version)
+    finally:
+        f.close()
+
+
+def write_atomic(path, data):
+    #write to a temporary file next to path and then move it over path, so a crash
+    #in the middle of saving never leaves a half-written save behind
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+    replace = getattr(os, 'replace', None)  # Python 3.3+
+    if replace is not None:
+        replace(tmp_path, path)
+    elif os.name == 'nt' and os.path.exists(path):
+        #Python 2 can't rename over an existing file on Windows, so this isn't atomic: the old file
+        #is moved out of the way first, and only deleted once the new one is in place. a crash in
+        #between leaves it at path + '.bak'.
+        bak_path = path + '.bak'
+        if os.path.exists(bak_path):
+            os.remove(bak_path)
+        os.rename(path, bak_path)
+        os.rename(tmp_path, path)
+        os.remove(bak_path)
+    else:
+        os.rename(tmp_path, path)
+
+
+class Journal:
+    #an append-only log of changes made since a save file was written. it starts with the
+    #checksum of that save, so a journal left over from an older save is never replayed
+    #over a newer one. every entry carries its own length and checksum, so an entry cut
+    #short by a crash is dropped along with anything after it.
+    def __init__(self, path):
+        self.path = path
+
+    def reset(self, save_data):
+        #start an empty journal for a save that was just written
+        write_atomic(self.path, JOURNAL_MAGIC + struct.pack('<I', checksum(save_data)))
+
+    def append(self, data):
+        f = open(self.path, 'ab')
+        try:
+            f.write(struct.pack('<II', len(data), checksum(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def size(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def read(self, save_data):
+        #the entries that go with the given save, oldest first
+        if not os.path.exists(self.path):
+            return []
+        f = open(self.path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        header_size = len(JOURNAL_MAGIC) + 4
+        if (len(data) < header_size or data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC or
+            struct.unpack_from('<I', data, len(JOURNAL_MAGIC))[0] != checksum(save_data)):
+            return []
+
+        entries = []
+        pos = header_size
+        while pos + 8 <= len(data):
+            (length, entry_checksum) = struct.unpack_from('<II', data, pos)
+            entry = data[pos + 8:pos + 8 + length]
+            if len(entry) != length or checksum(entry) != entry_checksum:
+                break
+            entries.append(entry)
+            pos += 8 + length
+        return entries
+
+
+class Spool:
+    #a long list of records kept in a file instead of memory: only the records that would fill the next
+    #chunk are held in memory, and full chunks are compressed with zlib and appended to the file in one
+    #write. reading a record back decompresses just its chunk. encode and decode turn a record into
+    #bytes and back. without a path, the file is a temporary one that's gone once the spool is closed.
+    def __init__(self, encode, decode, chunk_size=256, path=None):
+        self.encode = encode
+        self.decode = decode
+        self.chunk_size = chunk_size
+        self.file = open(path, 'w+b') if path is not None else tempfile.TemporaryFile()
+        self.chunks = []  # (offset, length) in the file of each chunk, all holding chunk_size records
+        self.pending = []  # records of the chunk that isn't full yet
+        self.cached = (None, [])  # the last chunk read back: (its number, its records)
+
+    def __len__(self):
+        return len(self.chunks) * self.chunk_size + len(self.pending)
+
+    def append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.chunk_size:
+            parts = []
+            for data in map(self.encode, self.pending):
+                parts.append(struct.pack('<I', len(data)))
+                parts.append(data)
+            data = zlib.compress(b''.join(parts))
+            self.file.seek(0, 2)
+            self.chunks.append((self.file.tell(), len(data)))
+            self.file.write(data)
+            self.pending = []
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('spool index out of range')
+        (chunk, i) = divmod(index, self.chunk_size)
+        if chunk == len(self.chunks):
+            return self.pending[i]
+
+        if self.cached[0] != chunk:
+            (offset, length) = self.chunks[chunk]
+            self.file.seek(offset)
+            self.cached = (chunk, self.decode_chunk(self.file.read(length)))
+        return self.cached[1][i]
+
+    def decode_chunk(self, data):
+        data = zlib.decompress(data)
+        records = []
+        pos = 0
+        while pos < len(data):
+            (size,) = struct.unpack_from('<I', data, pos)
+            records.append(self.decode(data[pos + 4:pos + 4 + size]))
+            pos += 4 + size
+        return records
+
+    def write(self, w):
+        #write all the records with a SaveWriter: the full chunks as they are, still compressed,
+        #and then the records that don't fill a chunk yet
+        w.pack('III', self.chunk_size, len(self.chunks), len(self.pending))
+        for (offset, length) in self.chunks:
+            self.file.seek(offset)
+            w.blob(self.file.read(length))
+        for record in self.pending:
+            w.blob(self.encode(record))
+
+    def read(self, r):
+        #append the records written by write(), with a SaveReader. chunks that line up with this
+        #spool's are copied in without being decompressed.
+        (chunk_size, chunks, pending) = r.unpack('III')
+        for i in range(chunks):
+            data = r.blob()
+            if chunk_size == self.chunk_size and not self.pending:
+                self.file.seek(0, 2)
+                self.chunks.append((self.file.tell(), len(data)))
+                self.file.write(data)
+            else:
+                for record in self.decode_chunk(data):
+                    self.append(record)
+        for i in range(pending):
+            self.append(self.decode(r.blob()))
+
+    def close(self):
+        self.file.close()
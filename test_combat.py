@@ -0,0 +1,52 @@
+import unittest
+
+import libtcodpy as libtcod
+import partyrogue
+
+
+def stack_of(name, quantity, hp, x=0, y=0, xp=10):
+    return partyrogue.Object(x, y, 'o', name, libtcod.white, blocks=True,
+                             first_combatant=partyrogue.Combatant(name, quantity=quantity, hp=hp, xp=xp))
+
+
+class SpreadDamageTest(unittest.TestCase):
+    def test_tough_stack_loses_no_one(self):
+        #every one has more hit points than the hit, so the stack stays whole and only the front is hurt
+        self.assertEqual(partyrogue.spread_damage(20, 3, 20, 15), (5, 3, 15))
+
+    def test_hurt_front_dies_and_next_takes_the_hit(self):
+        self.assertEqual(partyrogue.spread_damage(10, 3, 20, 15), (5, 2, 25))
+
+    def test_weak_stack_is_wiped_out(self):
+        self.assertEqual(partyrogue.spread_damage(4, 5, 10, 10), (0, 0, 44))
+
+    def test_single_one_killed(self):
+        self.assertEqual(partyrogue.spread_damage(7, 1, 20, 15), (0, 0, 7))
+
+
+class AreaDamageTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = (partyrogue.player, partyrogue.object_index)
+        partyrogue.player = stack_of('player', 1, 30, x=9, y=9, xp=0)
+        self.orcs = stack_of('orc', 4, 20)
+        partyrogue.object_index = partyrogue.SpatialIndex([partyrogue.player, self.orcs])
+
+    def tearDown(self):
+        (partyrogue.player, partyrogue.object_index) = self.previous
+
+    def test_stack_tougher_than_the_hit(self):
+        hit = partyrogue.area_damage(0, 0, 1, 15, partyrogue.player)
+        orcs = self.orcs.combatant[0]
+        self.assertEqual(hit, [('orc', 15)])
+        self.assertEqual((orcs.hp, orcs.quantity), (5, 4))
+        self.assertEqual(partyrogue.player.combatant[0].xp, 0)
+
+    def test_stack_weaker_than_the_hit(self):
+        hit = partyrogue.area_damage(0, 0, 1, 20, partyrogue.player)
+        self.assertEqual(hit, [('orc', 80)])
+        self.assertFalse(partyrogue.living_combatants(self.orcs))
+        self.assertEqual(partyrogue.player.combatant[0].xp, 40)
+
+
+if __name__ == '__main__':
+    unittest.main()